@@ -0,0 +1,366 @@
+"""
+Exposition
+==========
+
+Pre-rendered metrics served on every scrape.
+
+Collection cycle renders metrics once into an immutable snapshot holding
+plain and gzip compressed exposition. Scrapes are answered from the latest
+snapshot, reference to the snapshot is swapped atomically.
+
+Age of the served snapshot is appended to every response, for gzip encoding
+as a separate gzip member.
+
+With `OnDemand` a scrape collects when the snapshot is older than TTL,
+concurrent scrapes wait for the same collection in flight.
+
+`SnapshotServer` is an asyncio HTTP/1.1 server serving snapshots on the
+event loop of the scheduler (keep-alive, connection limit, request timeout,
+optional UNIX socket). `start_snapshot_server` serves from a thread instead.
+
+.. code-block:: python
+
+    server = SnapshotServer(collector, max_connections=64, timeout=10)
+    scheduler.add_coroutine(server.serve(9121, '0.0.0.0', unix_socket='/run/libvirt_exporter.sock'))
+
+.. code-block:: python
+
+    on_demand = OnDemand(lambda: prom_stats(libv_meta, collector), ttl=10)
+    server = SnapshotServer(collector, on_demand=on_demand)
+
+.. code-block:: python
+
+    from exposition import Snapshot
+    from exposition import start_snapshot_server
+
+    collector.snapshot = Snapshot(generate_latest(registry))
+    start_snapshot_server(9121, '0.0.0.0', collector)
+
+"""
+import asyncio
+import concurrent.futures
+import gzip
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.exposition import CONTENT_TYPE_LATEST
+
+AGE_METRIC = (
+    b'# HELP libvirt_exporter_snapshot_age_seconds Age of the served snapshot\n'
+    b'# TYPE libvirt_exporter_snapshot_age_seconds gauge\n'
+    b'libvirt_exporter_snapshot_age_seconds %f\n'
+)
+
+
+class Snapshot:
+    """
+    Snapshot of rendered metrics.
+
+    Immutable, shared by all scrapes until replaced by the next one.
+    """
+
+    __slots__ = ('data', 'gzip', 'created', 'samples')
+
+    def __init__(self, data=b''):
+        """
+        :param bytes data: metrics in text exposition format
+        """
+        self.data = data
+        self.gzip = gzip.compress(data, compresslevel=6)
+        self.created = time.time()
+        self.samples = sum(1 for line in data.split(b'\n') if line and not line.startswith(b'#'))
+
+    def body(self, accept_encoding=''):
+        """
+        Get body and content encoding negotiated by Accept-Encoding header.
+
+        :return tuple: body, content encoding (None for plain text)
+        """
+        if 'gzip' in (accept_encoding or ''):
+            return self.gzip, 'gzip'
+        return self.data, None
+
+    def trailer(self, encoding=None):
+        """
+        Get age of the snapshot in exposition format.
+
+        :param str encoding: content encoding of the body
+        :return bytes: metric appended to the body
+        """
+        age = AGE_METRIC % (time.time() - self.created)
+        if encoding == 'gzip':
+            return gzip.compress(age, compresslevel=1)
+        return age
+
+
+class OnDemand:
+    """
+    Collection triggered by scrapes.
+
+    Collection runs in its own thread when the last one is older than `ttl`
+    seconds, scrapes arriving meanwhile join it (single-flight). Scrapes wait
+    for the collection at most `timeout` seconds, then the previous snapshot
+    is served.
+    """
+
+    def __init__(self, collect, ttl=10, timeout=10):
+        """
+        :param collect: callable collecting and rendering a new snapshot
+        :param float ttl: seconds a collected snapshot is served without collection
+        :param float timeout: seconds a scrape waits for collection
+        """
+        self.collect = collect
+        self.ttl = ttl
+        self.timeout = timeout
+        self.collected = None  # monotonic time of the last collection start
+        self.scrapes = {'cached': 0, 'collected': 0, 'joined': 0}
+        self.__flight = None
+        self.__lock = threading.Lock()
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='collect-on-demand')
+
+    def __run(self):
+        try:
+            self.collect()
+        except Exception:
+            pass
+
+    def start(self):
+        """
+        Start collection unless the snapshot is fresh or collection is in flight.
+
+        :return Future: collection to wait for (None: snapshot is fresh)
+        """
+        with self.__lock:
+            if self.__flight is not None and not self.__flight.done():
+                self.scrapes['joined'] += 1
+                return self.__flight
+            now = time.monotonic()
+            if self.collected is not None and now - self.collected < self.ttl:
+                self.scrapes['cached'] += 1
+                return None
+            self.scrapes['collected'] += 1
+            self.collected = now
+            self.__flight = self.__executor.submit(self.__run)
+            return self.__flight
+
+    def wait(self):
+        """Refresh snapshot from a thread."""
+        flight = self.start()
+        if flight is not None:
+            try:
+                flight.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                pass
+
+    async def refresh(self):
+        """Refresh snapshot from the event loop."""
+        flight = self.start()
+        if flight is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def collect_metrics(self):
+        """Yield counters of scrapes."""
+        g = CounterMetricFamily(
+            'libvirt_exporter_on_demand_scrapes',
+            'Scrapes served from cache, by new collection or by joining collection in flight',
+            labels=['result'])
+        for result, count in self.scrapes.items():
+            g.add_metric([result], count)
+        yield g
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    """HTTP handler serving snapshot of `source`."""
+
+    source = None
+    on_demand = None
+
+    def do_GET(self):
+        if self.on_demand is not None:
+            self.on_demand.wait()
+        snapshot = self.source.snapshot
+        body, encoding = snapshot.body(self.headers.get('Accept-Encoding'))
+        trailer = snapshot.trailer(encoding)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body) + len(trailer)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.write(trailer)
+
+    def log_message(self, format, *args):
+        """Do not log scrapes."""
+
+
+def start_snapshot_server(port, addr, source, on_demand=None):
+    """
+    Start HTTP server serving snapshots in a daemon thread.
+
+    :param int port: port to listen on
+    :param str addr: address to bind
+    :param source: object holding the latest `snapshot`
+    :param OnDemand on_demand: collect on scrapes (None: serve snapshot as is)
+    """
+    handler = type('SnapshotHandler', (SnapshotHandler,), {'source': source, 'on_demand': on_demand})
+    httpd = ThreadingHTTPServer((addr, port), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    return httpd
+
+
+class SnapshotServer:
+    """
+    Asyncio HTTP/1.1 server of snapshots.
+
+    Requests are answered on the event loop from the latest snapshot of
+    `source`, no worker thread is involved.
+    """
+
+    PATHS = ['/', '/metrics']
+    MAX_REQUEST_SIZE = 16384
+
+    def __init__(self, source, max_connections=64, timeout=10, on_demand=None):
+        """
+        :param source: object holding the latest `snapshot`
+        :param int max_connections: open connections, further are refused with 503
+        :param float timeout: seconds to receive request (also idle keep-alive timeout)
+        :param OnDemand on_demand: collect on scrapes (None: serve snapshot as is)
+        """
+        self.source = source
+        self.on_demand = on_demand
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+        self.servers = []
+
+    async def serve(self, port=None, addr='0.0.0.0', unix_socket=None):
+        """
+        Listen on TCP `port` and/or `unix_socket` until cancelled.
+
+        :param int port: TCP port (None: no TCP listener)
+        :param str addr: address to bind
+        :param str unix_socket: path of UNIX socket (None: no UNIX listener)
+        """
+        if port is not None:
+            self.servers.append(await asyncio.start_server(
+                self.handle, addr, port, limit=self.MAX_REQUEST_SIZE))
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self.servers.append(await asyncio.start_unix_server(
+                self.handle, unix_socket, limit=self.MAX_REQUEST_SIZE))
+        try:
+            await asyncio.gather(*[server.serve_forever() for server in self.servers])
+        finally:
+            for server in self.servers:
+                server.close()
+
+    async def handle(self, reader, writer):
+        """Handle connection, requests are served until closed or idle."""
+        if self.connections >= self.max_connections:
+            self.rejected += 1
+            try:
+                writer.write(self.response(503, b'Too many connections\n', close=True))
+            except Exception:
+                pass
+            await self.close(writer)
+            return
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+                keep_alive = await self.respond(head, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except Exception:
+            # Errors of a connection must not reach loop exception handler
+            pass
+        finally:
+            self.connections -= 1
+            await self.close(writer)
+
+    async def respond(self, head, reader, writer):
+        """
+        Write response to request.
+
+        :param bytes head: request line and headers
+        :return bool: connection is kept alive
+        """
+        self.requests += 1
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            writer.write(self.response(400, b'Bad request\n', close=True))
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        length = int(headers.get('content-length', 0) or 0)
+        if length:
+            if length > self.MAX_REQUEST_SIZE:
+                writer.write(self.response(413, b'Request too large\n', close=True))
+                return False
+            await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        if method not in ['GET', 'HEAD']:
+            writer.write(self.response(405, b'Method not allowed\n', close=not keep_alive))
+            return keep_alive
+        if target.split('?', 1)[0] not in self.PATHS:
+            writer.write(self.response(404, b'Not found\n', close=not keep_alive))
+            return keep_alive
+
+        if self.on_demand is not None:
+            await self.on_demand.refresh()
+        snapshot = self.source.snapshot
+        body, encoding = snapshot.body(headers.get('accept-encoding'))
+        trailer = snapshot.trailer(encoding)
+        headers = [('Content-Type', CONTENT_TYPE_LATEST)]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        writer.write(self.response(
+            200, length=len(body) + len(trailer), headers=headers, close=not keep_alive))
+        if method == 'GET':
+            writer.write(body)
+            writer.write(trailer)
+        return keep_alive
+
+    def response(self, status, body=b'', length=None, headers=(), close=False):
+        """Response head (and body if given)."""
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  413: 'Payload Too Large', 503: 'Service Unavailable'}[status]
+        head = ['HTTP/1.1 {} {}'.format(status, reason)]
+        head.extend('{}: {}'.format(key, value) for key, value in headers)
+        if body and not headers:
+            head.append('Content-Type: text/plain; charset=utf-8')
+        head.append('Content-Length: {}'.format(len(body) if length is None else length))
+        head.append('Connection: {}'.format('close' if close else 'keep-alive'))
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+    async def close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
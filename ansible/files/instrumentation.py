@@ -0,0 +1,241 @@
+"""
+Instrumentation
+===============
+
+Metrics of the exporter itself.
+
+Collection cycle is broken down into phases, time spent in every phase is
+summed over the cycle (and over domains collected in parallel) and observed
+in histograms when the cycle ends. Calls to libvirt API are counted and timed
+by a proxy wrapping the connection and domains. Failed extractors are counted
+instead of being dropped silently.
+
+.. code-block:: python
+
+    from instrumentation import Instrumentation
+
+    instrumentation = Instrumentation()
+    conn = instrumentation.wrap(conn)
+
+    instrumentation.begin_cycle()
+    with instrumentation.phase('list'):
+        domains = conn.listAllDomains()
+    instrumentation.error('memory')
+    instrumentation.end_cycle()
+
+    registry.register(instrumentation)
+
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import HistogramMetricFamily
+from prometheus_client.core import SummaryMetricFamily
+
+try:
+    import libvirt
+    LIBVIRT_TYPES = (libvirt.virConnect, libvirt.virDomain)
+except Exception:
+    LIBVIRT_TYPES = ()
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Cumulative histogram of observed durations."""
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+
+    def buckets(self):
+        """Cumulative buckets in format of `HistogramMetricFamily`."""
+        buckets = []
+        total = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            total += count
+            buckets.append(('+Inf' if bound == float('inf') else str(bound), total))
+        return buckets
+
+
+class LibvirtProxy:
+    """
+    Proxy of libvirt connection or domain.
+
+    Calls of methods are counted and timed, returned connections and domains
+    are wrapped as well. Wrapped objects passed as arguments are unwrapped.
+    """
+
+    __slots__ = ('_obj', '_instrumentation')
+
+    def __init__(self, obj, instrumentation):
+        self._obj = obj
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        instrumentation = self._instrumentation
+
+        def call(*args, **kwargs):
+            args = [unwrap(arg) for arg in args]
+            kwargs = dict((key, unwrap(value)) for key, value in kwargs.items())
+            start = time.monotonic()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                seconds = time.monotonic() - start
+                instrumentation.api_call(name, seconds, failed=True)
+                if instrumentation.recorder is not None:
+                    instrumentation.recorder.record(self._obj, name, args, kwargs, error=e, seconds=seconds)
+                raise
+            seconds = time.monotonic() - start
+            instrumentation.api_call(name, seconds)
+            if instrumentation.recorder is not None:
+                instrumentation.recorder.record(self._obj, name, args, kwargs, result=result, seconds=seconds)
+            return instrumentation.wrap(result)
+
+        call.__name__ = name
+        return call
+
+    def __eq__(self, other):
+        return self._obj == unwrap(other)
+
+    def __hash__(self):
+        return hash(self._obj)
+
+
+def unwrap(value):
+    """Unwrap libvirt objects (also in lists) from proxies."""
+    if isinstance(value, LibvirtProxy):
+        return value._obj
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+
+class Instrumentation:
+    """
+    Exporter self-instrumentation.
+
+    Collector of phase durations, libvirt API calls and extractor errors.
+    Calls are also passed to `recorder` when set (see `libvirtreplay`).
+    """
+
+    def __init__(self):
+        self.recorder = None
+        self.phases = {}  # phase -> Histogram
+        self.cycles = Histogram()
+        self.api_calls = {}  # API -> [calls, errors, seconds]
+        self.errors = {}  # extractor -> errors
+        self.__cycle = {}
+        self.__cycle_start = None
+        self.__lock = threading.Lock()
+
+    def wrap(self, value):
+        """
+        Wrap libvirt connection and domains (also in lists and tuples).
+
+        :return: proxied value
+        """
+        if isinstance(value, LIBVIRT_TYPES):
+            return LibvirtProxy(value, self)
+        if isinstance(value, list):
+            return [self.wrap(item) for item in value]
+        if isinstance(value, tuple) and value and isinstance(value[0], LIBVIRT_TYPES):
+            return (LibvirtProxy(value[0], self),) + value[1:]
+        return value
+
+    def api_call(self, name, seconds, failed=False):
+        """Record call of libvirt API."""
+        with self.__lock:
+            calls = self.api_calls.get(name)
+            if calls is None:
+                calls = self.api_calls[name] = [0, 0, 0.0]
+            calls[0] += 1
+            calls[1] += failed
+            calls[2] += seconds
+
+    def error(self, extractor):
+        """Record failure of an extractor."""
+        with self.__lock:
+            self.errors[extractor] = self.errors.get(extractor, 0) + 1
+
+    def begin_cycle(self):
+        """Start collection cycle."""
+        with self.__lock:
+            self.__cycle = {}
+            self.__cycle_start = time.monotonic()
+
+    def end_cycle(self):
+        """Observe durations of phases and of the whole cycle."""
+        with self.__lock:
+            for phase, seconds in self.__cycle.items():
+                if phase not in self.phases:
+                    self.phases[phase] = Histogram()
+                self.phases[phase].observe(seconds)
+            if self.__cycle_start is not None:
+                self.cycles.observe(time.monotonic() - self.__cycle_start)
+            self.__cycle = {}
+            self.__cycle_start = None
+
+    @contextmanager
+    def phase(self, name):
+        """Add time spent in the block to phase of the current cycle."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self.__lock:
+                self.__cycle[name] = self.__cycle.get(name, 0.0) + seconds
+
+    def collect(self):
+        # Copied under the lock, families are built and yielded without it
+        with self.__lock:
+            cycles = (self.cycles.buckets(), self.cycles.sum)
+            phases = [(phase, histogram.buckets(), histogram.sum) for phase, histogram in self.phases.items()]
+            api_calls = [(name, list(calls)) for name, calls in self.api_calls.items()]
+            errors = list(self.errors.items())
+        g = HistogramMetricFamily(
+            'libvirt_exporter_cycle_seconds', 'Duration of collection cycles')
+        g.add_metric([], *cycles)
+        yield g
+        g = HistogramMetricFamily(
+            'libvirt_exporter_phase_seconds',
+            'Time spent in a phase of collection cycle (summed over domains)',
+            labels=['phase'])
+        for phase, buckets, total in phases:
+            g.add_metric([phase], buckets, total)
+        yield g
+        g = SummaryMetricFamily(
+            'libvirt_exporter_libvirt_call_seconds', 'Calls of libvirt API and their duration',
+            labels=['api'])
+        for name, (calls, failed, seconds) in api_calls:
+            g.add_metric([name], calls, seconds)
+        yield g
+        g = CounterMetricFamily(
+            'libvirt_exporter_libvirt_call_errors', 'Failed calls of libvirt API', labels=['api'])
+        for name, (calls, failed, seconds) in api_calls:
+            g.add_metric([name], failed)
+        yield g
+        g = CounterMetricFamily(
+            'libvirt_exporter_extractor_errors', 'Failures of stats and metadata extractors',
+            labels=['extractor'])
+        for extractor, count in errors:
+            g.add_metric([extractor], count)
+        yield g
@@ -37,14 +37,23 @@ Memory  :py:func:`node_exporters.libvirt.libvirt_only.get_mem_stats`
 
 """
 import argparse
+import asyncio
+import concurrent.futures
 import sys
+import time
 
-from prometheus_client import start_http_server
+from exposition import OnDemand
+from exposition import Snapshot
+from exposition import SnapshotServer
+from exposition import start_snapshot_server
 from prometheus_client.core import REGISTRY
+from prometheus_client.core import CounterMetricFamily
 from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import generate_latest
 
 try:
     from libvirtmetadata import LibvirtMetadata
+    from libvirtmetadata import STATS_GROUPS
 except Exception:
     libvirtmetadata = None
 try:
@@ -54,11 +63,29 @@ except Exception:
 
 
 class CustomCollector(object):
-    def __init__(self, helper, helper_name='unknown', libv_meta=None):
+    def __init__(self, helper, helper_name='unknown', libv_meta=None, registry=REGISTRY):
         self.ALL_STATS = []
         self.HELPER = helper
         self.HELPER_NAME = helper_name
         self.libv_meta = libv_meta
+        self.registry = registry
+        self.snapshot = Snapshot()
+        self.scheduler = None
+        self.on_demand = None
+        self.WORKERS = 0  # parallel collection of domains (0: sequential)
+        self.DOMAIN_TIMEOUT = 10  # seconds
+        self.executor = None
+        self.LAST_DOMAIN_STATS = {}
+        self.DOMAIN_TIMEOUTS = {}
+        self.RUNNING_DOMAINS = set()
+
+    def render(self):
+        """
+        Render registry into snapshot served on scrapes.
+
+        Called once per collection cycle, scrapes do not collect.
+        """
+        self.snapshot = Snapshot(generate_latest(self.registry))
 
     def collect(self):
         items = {}
@@ -84,9 +111,82 @@ class CustomCollector(object):
                 )
                 g.add_metric([self.HELPER_NAME], self.libv_meta.status)
                 yield g
+                connection = self.libv_meta.connection
+                g = GaugeMetricFamily(
+                    'libvirt_connection_age_seconds',
+                    'Seconds since the libvirt connection was opened (0 if closed)',
+                    labels=['node_exporter']
+                )
+                g.add_metric([self.HELPER_NAME], connection.age)
+                yield g
+                g = CounterMetricFamily(
+                    'libvirt_connection_reconnects',
+                    'Number of times the libvirt connection was reopened',
+                    labels=['node_exporter']
+                )
+                g.add_metric([self.HELPER_NAME], connection.reconnects)
+                yield g
+                g = GaugeMetricFamily(
+                    'libvirt_connection_handshake_seconds',
+                    'Time to open the last libvirt connection',
+                    labels=['node_exporter']
+                )
+                g.add_metric([self.HELPER_NAME], connection.handshake_time)
+                yield g
+                g = GaugeMetricFamily(
+                    'libvirt_exporter_instances', 'Number of instances in metadata store')
+                g.add_metric([], len(self.libv_meta.LIBVIRT_INSTANCES))
+                yield g
+                g = CounterMetricFamily(
+                    'libvirt_exporter_instance_evictions',
+                    'Instances evicted from metadata store (deleted domain, expired, over capacity)',
+                    labels=['reason'])
+                for reason, count in self.libv_meta.INSTANCE_EVICTIONS.items():
+                    g.add_metric([reason], count)
+                yield g
+        except Exception:
+            pass
+
+        try:
+            if self.scheduler:
+                yield from self.collect_tasks(self.scheduler.task_stats.values())
+            if self.on_demand:
+                yield from self.on_demand.collect_metrics()
         except Exception:
             pass
 
+        try:
+            if self.libv_meta:
+                yield from self.libv_meta.instrumentation.collect()
+            # Rendered snapshot includes sizes of the previous one
+            g = GaugeMetricFamily(
+                'libvirt_exporter_snapshot_samples', 'Number of samples in the last snapshot')
+            g.add_metric([], self.snapshot.samples)
+            yield g
+            g = GaugeMetricFamily(
+                'libvirt_exporter_snapshot_bytes', 'Size of the last snapshot (uncompressed)')
+            g.add_metric([], len(self.snapshot.data))
+            yield g
+        except Exception:
+            pass
+
+    def collect_tasks(self, task_stats):
+        """Yield accounting of scheduler periodic tasks."""
+        families = [
+            (CounterMetricFamily, 'runs', 'Number of started runs of the task'),
+            (CounterMetricFamily, 'skipped', 'Number of runs dropped as previous run was in progress'),
+            (CounterMetricFamily, 'coalesced', 'Number of runs merged into a single run after previous one'),
+            (GaugeMetricFamily, 'lateness', 'Seconds the last run started after its scheduled time'),
+            (GaugeMetricFamily, 'duration', 'Duration of the last finished run'),
+            (GaugeMetricFamily, 'running', 'Whether the task is running now'),
+        ]
+        for family, attr, helper in families:
+            suffix = '_seconds' if attr in ['lateness', 'duration'] else ''
+            g = family('libvirt_exporter_task_{}{}'.format(attr, suffix), helper, labels=['task'])
+            for state in task_stats:
+                g.add_metric([state.name], float(getattr(state, attr)))
+            yield g
+
 
 def get_cpu_stats(stats):
     """
@@ -140,7 +240,7 @@ def get_cpu_stats(stats):
                 stats.get('vcpu.{}.time'.format(i), 0) / 1000)
         vcpu_state = stats.get('vcpu.{}.state'.format(i), 0)
         items['cpu_use_count'] += 1 if vcpu_state == 1 else 0
-        items['variable']['vcpu:{}'.format(i)] = {
+        items['variable'][(('vcpu', str(i)),)] = {
             'vcpu_utime': int(stats.get('vcpu.{}.time'.format(i), 0) / 1000),
         }
     return items
@@ -253,7 +353,7 @@ def get_disk_io_stats(stats):
         items['disk_read_count'] += stats.get('block.{}.rd.times'.format(i), 0)
         disk_name = stats.get('block.{}.name'.format(i), None)
         if disk_name:
-            items['variable']['device:{}'.format(disk_name)] = {
+            items['variable'][(('device', disk_name),)] = {
                 'dev_total_bytes': stats.get('block.{}.physical'.format(i), 0),
                 'dev_write_bytes': stats.get('block.{}.wr.bytes'.format(i), 0),
                 'dev_read_bytes': stats.get('block.{}.rd.bytes'.format(i), 0),
@@ -263,7 +363,7 @@ def get_disk_io_stats(stats):
     return items
 
 
-def get_mem_stats(domain, stats):
+def get_mem_stats(domain, stats, nowait=False):
     """
     Get memory stats.
 
@@ -288,94 +388,350 @@ def get_mem_stats(domain, stats):
         not be useful for user or billing. Will have to review with higher versions of
         Openstack when we move on.
 
+    Balloon values of bulk stats are used when libvirt provides them (rss
+    included), otherwise memory stats are requested from the domain. Stats
+    fetched with NOWAIT miss them while domain job is busy, memory stats
+    would wait for the job, so memory is skipped for the cycle instead.
+
     :param domain: libvirt domain object for extra stats.
     :param dict stats: statistics data retrieved from libvirt.
+    :param bool nowait: `stats` were fetched with NOWAIT flag
 
     :return dict: stats
     """
-    items = {}
-    try:
-        mem = domain.memoryStats()
-        items = {
-            'mem_use_bytes': 1000 * mem.get('available', 0) if mem.get('available', 0) >= 0 else 0,
-            'mem_rss_bytes': 1000 * mem.get('rss', 0) if mem.get('rss', 0) >= 0 else 0,
-            'mem_free_bytes': 1000 * mem.get('unused', 0) if mem.get('unused', 0) >= 0 else 0,
-            'mem_max_bytes': 1000 * mem.get('actual', 0) if mem.get('actual', 0) >= 0 else 0,
+    if 'balloon.rss' in stats:
+        # Bulk balloon stats carry the same values as memoryStats
+        mem = {
+            'available': stats.get('balloon.available', 0),
+            'rss': stats.get('balloon.rss', 0),
+            'unused': stats.get('balloon.unused', 0),
+            'actual': stats.get('balloon.current', 0),
         }
+    elif nowait:
+        return {}
+    else:
+        try:
+            mem = domain.memoryStats()
+        except Exception:
+            return {
+                'mem_use_bytes': 1000 * stats.get('balloon.current', 0),
+                'mem_max_bytes': 1000 * stats.get('balloon.maximum', 0),
+            }
+    return {
+        'mem_use_bytes': 1000 * mem.get('available', 0) if mem.get('available', 0) >= 0 else 0,
+        'mem_rss_bytes': 1000 * mem.get('rss', 0) if mem.get('rss', 0) >= 0 else 0,
+        'mem_free_bytes': 1000 * mem.get('unused', 0) if mem.get('unused', 0) >= 0 else 0,
+        'mem_max_bytes': 1000 * mem.get('actual', 0) if mem.get('actual', 0) >= 0 else 0,
+    }
+
+
+def get_control_info(domain):
+    """
+    Get control state and time of the domain job.
+
+    :param domain: libvirt domain object.
+
+    :return tuple: control state, control time (seconds)
+    """
+    try:
+        control_info = domain.controlInfo()
     except Exception:
-        items = {
-            'mem_use_bytes': 1000 * stats.get('balloon.current', 0),
-            'mem_max_bytes': 1000 * stats.get('balloon.maximum', 0),
-        }
-    return items
+        return 4, -1
+    try:
+        control_state = int(control_info[0])
+    except Exception:
+        control_state = 4
+    try:
+        control_time = int(control_info[-1] / 1000)
+    except Exception:
+        control_time = -1
+    return control_state, control_time
+
+
+def collect_domain(libv_meta, dom, control_info=None, stats=None, conn=None):
+    """
+    Collect and export stats of a single domain.
+
+    :param libv_meta: LibvirtMetadata instance
+    :param dom: libvirt domain object.
+    :param tuple control_info: control state and time (requested when missing)
+    :param dict stats: bulk stats of the domain (requested using `conn` when missing)
+    :param conn: libvirt connection for a per-domain stats call
+
+    :return list: exported stats
+    """
+    all_stats = []
+    instrumentation = libv_meta.instrumentation
+    instance = dom.name()
+    if control_info is None:
+        with instrumentation.phase('list'):
+            control_info = get_control_info(dom)
+    control_state, control_time = control_info
+    domain = dom
+    if stats is None and conn is not None:
+        with instrumentation.phase('stats'):
+            domain, stats = libv_meta.get_domain_stats(
+                conn, [dom], {instance: (control_state, control_time)}).get(instance, (dom, None))
+    try:
+        if stats and 'state.state' in stats:
+            state = int(stats['state.state'])
+        else:
+            state = int(dom.state()[0])
+    except Exception:
+        instrumentation.error('state')
+        state = 0
+    with instrumentation.phase('metadata'):
+        metadata = libv_meta.get_instance_metadata(instance, dom)
+    try:
+        with instrumentation.phase('export'):
+            all_stats.extend(libv_meta.export_info(instance, metadata=metadata))
+            all_stats.extend(libv_meta.export({
+                'vm_control_time': control_time,
+                'vm_control_state': control_state,
+                'vm_state': state,
+                'vm_stats_quarantine': libv_meta.QUARANTINE.level(instance),
+            }, instance, metadata=metadata))
+    except Exception:
+        instrumentation.error('state')
+    if not stats or state != libv_meta.DOMAIN_RUNNING:
+        return all_stats
+    for extractor, phase, get_items, args in [
+        ('cpu', 'stats', get_cpu_stats, (stats,)),
+        ('net', 'stats', get_net_stats, (stats,)),
+        ('disk', 'stats', get_disk_io_stats, (stats,)),
+        ('memory', 'memory_stats', get_mem_stats, (domain, stats, bool(stats) and libv_meta.nowait)),
+        ('cpu_meta', 'metadata', libv_meta.get_cpu_meta, (domain, stats)),
+        ('gpu', 'gpu', libv_meta.get_gpu_meta, (domain, stats)),
+    ]:
+        try:
+            with instrumentation.phase(phase):
+                items = get_items(*args)
+            with instrumentation.phase('export'):
+                all_stats.extend(libv_meta.export(items, instance, metadata=metadata))
+        except Exception:
+            instrumentation.error(extractor)
+    return all_stats
+
+
+def collect_parallel(libv_meta, cc, conn, domains):
+    """
+    Collect domains in parallel using bounded worker pool.
+
+    Every domain is collected by its own task (control info, stats and
+    metadata). Task queued or running longer than `cc.DOMAIN_TIMEOUT`
+    seconds misses its deadline, last known stats of the domain are
+    exported instead and its timeout counter is increased. Domain still
+    running from previous cycle is not submitted again.
+
+    :return list: exported stats
+    """
+    if cc.executor is None:
+        cc.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=cc.WORKERS, thread_name_prefix='collect')
+    started = {}
+
+    def task(dom):
+        instance = dom.name()
+        started[instance] = time.monotonic()
+        try:
+            cc.LAST_DOMAIN_STATS[instance] = collect_domain(libv_meta, dom, conn=conn)
+        finally:
+            cc.RUNNING_DOMAINS.discard(instance)
+
+    futures = {}
+    timed_out = []
+    submitted = time.monotonic()
+    for dom in domains:
+        instance = dom.name()
+        if instance in cc.RUNNING_DOMAINS:
+            timed_out.append(instance)
+            continue
+        cc.RUNNING_DOMAINS.add(instance)
+        futures[cc.executor.submit(task, dom)] = instance
+
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        deadlines = dict(
+            (future, started.get(futures[future], submitted) + cc.DOMAIN_TIMEOUT) for future in pending)
+        for future, deadline in deadlines.items():
+            if deadline <= now:
+                pending.discard(future)
+                timed_out.append(futures[future])
+                if future.cancel():
+                    cc.RUNNING_DOMAINS.discard(futures[future])
+        if pending:
+            _, pending = concurrent.futures.wait(
+                pending, timeout=max(min(deadlines[f] for f in pending) - now, 0.01),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+    return export_last_stats(libv_meta, cc, domains, timed_out)
+
+
+def export_last_stats(libv_meta, cc, domains, timed_out):
+    """
+    Export last known stats of domains and their timeouts.
+
+    Timeouts of `timed_out` domains are increased, domains gone are evicted.
+
+    :return list: exported stats
+    """
+    for instance in timed_out:
+        cc.DOMAIN_TIMEOUTS[instance] = cc.DOMAIN_TIMEOUTS.get(instance, 0) + 1
+
+    all_stats = []
+    instances = set()
+    for dom in domains:
+        instance = dom.name()
+        instances.add(instance)
+        all_stats.extend(cc.LAST_DOMAIN_STATS.get(instance, []))
+        try:
+            all_stats.extend(libv_meta.export({
+                'vm_collect_timeouts': cc.DOMAIN_TIMEOUTS.get(instance, 0),
+            }, instance, metadata=libv_meta.get_instance_metadata(instance, dom)))
+        except Exception:
+            pass
+    for store in (cc.LAST_DOMAIN_STATS, cc.DOMAIN_TIMEOUTS):
+        for instance in list(store.keys()):
+            if instance not in instances:
+                store.pop(instance, None)
+    return all_stats
 
 
 def prom_stats(libv_meta, cc):
-    """Gather and export prometheus stats."""
+    """
+    Gather and export prometheus stats.
+
+    Stats of all running domains are fetched in bulk, busy or misbehaving
+    domains are quarantined (see `DomainQuarantine`). With `cc.WORKERS`
+    domains are collected in parallel instead (see `collect_parallel`).
+    """
     all_stats = []
+    instrumentation = libv_meta.instrumentation
+    instrumentation.begin_cycle()
 
     try:
         with libv_meta.libvirt_connection() as conn:
-            # all_domain_stats = conn.getAllDomainStats(stats=libv_meta.STATS, flags=libv_meta.FLAGS)
-            # for domain, stats in all_domain_stats:
-            for dom in conn.listAllDomains(flags=libv_meta.LIST_DOMAINS_RUNNING):
-                stat_list = []
-                try:
-                    state = int(dom.state()[0])
-                except Exception:
-                    state = 0
-                try:
-                    control_state = int(dom.controlInfo()[0])
-                except Exception:
-                    control_state = 4
-                try:
-                    control_time = int(dom.controlInfo()[-1] / 1000)
-                except Exception:
-                    control_time = -1
-                try:
-                    instance = dom.name()
-                    metadata = libv_meta.get_instance_metadata(instance, dom)
-                    try:
-                        all_stats.extend(libv_meta.export({
-                            'vm_control_time': control_time,
-                            'vm_control_state': control_state,
-                            'vm_state': state
-                        }, instance, metadata=metadata))
-                    except Exception:
-                        pass
-                    if state == libv_meta.DOMAIN_RUNNING and control_time < 300 and control_time >= 0:
-                        # Ignore if domain not running or busy/locked for more than 5 min
-                        stat_list = conn.domainListGetStats(
-                            [dom], stats=libv_meta.STATS, flags=libv_meta.FLAGS)
-                except Exception:
-                    stat_list = []
-                for domain, stats in stat_list:
-                    try:
-                        all_stats.extend(libv_meta.export(
-                            get_cpu_stats(stats), instance, metadata=metadata))
-                        all_stats.extend(libv_meta.export(
-                            get_net_stats(stats), instance, metadata=metadata))
-                        all_stats.extend(libv_meta.export(
-                            get_disk_io_stats(stats), instance, metadata=metadata))
-                        all_stats.extend(libv_meta.export(get_mem_stats(
-                            domain, stats), instance, metadata=metadata))
-                        all_stats.extend(libv_meta.export(libv_meta.get_cpu_meta(
-                            domain), instance, metadata=metadata))
-                    except Exception:
-                        pass
-                    try:
-                        all_stats.extend(libv_meta.export(libv_meta.get_gpu_meta(
-                            domain), instance, metadata=metadata, prefix='libv_'))
-                    except Exception:
-                        pass
+            with instrumentation.phase('list'):
+                domains = conn.listAllDomains(flags=libv_meta.LIST_DOMAINS_RUNNING)
+            if cc.WORKERS > 0:
+                all_stats.extend(collect_parallel(libv_meta, cc, conn, domains))
+            else:
+                with instrumentation.phase('list'):
+                    control_info = dict((dom.name(), get_control_info(dom)) for dom in domains)
+                with instrumentation.phase('stats'):
+                    domain_stats = libv_meta.get_domain_stats(conn, domains, control_info)
+                for dom in domains:
+                    domain, stats = domain_stats.get(dom.name(), (dom, None))
+                    all_stats.extend(collect_domain(
+                        libv_meta, domain, control_info[dom.name()], stats))
             try:
-                all_stats.extend(libv_meta.export(libv_meta.get_gpu_device_meta(), None, prefix='libv_'))
+                with instrumentation.phase('gpu'):
+                    items = libv_meta.get_gpu_device_meta()
+                with instrumentation.phase('export'):
+                    all_stats.extend(libv_meta.export(items, None, prefix='libv_'))
             except Exception as e:
+                instrumentation.error('gpu_device')
                 print(e)
     except Exception:
         libv_meta.status = 1  # error
 
     cc.ALL_STATS = all_stats
+    with instrumentation.phase('render'):
+        cc.render()
+    instrumentation.end_cycle()
+
+
+async def prom_stats_async(libv_meta, cc):
+    """
+    Gather and export prometheus stats on the event loop.
+
+    Libvirt calls run in a bounded executor (`cc.WORKERS` threads, 4 when
+    0) and are awaited at most `cc.DOMAIN_TIMEOUT` seconds, a hung call
+    holds one worker, not the loop. Stats are fetched in bulk chunks
+    (`STATS_CHUNK` domains, domains split over workers when 0), each chunk
+    with its own deadline. Domains of a chunk missing its deadline are
+    retried one by one, domains are then collected concurrently. Domain
+    missing its deadline, or still running from previous cycle, is exported
+    with last known stats (see `collect_parallel`).
+    """
+    loop = asyncio.get_event_loop()
+    workers = cc.WORKERS or 4
+    if cc.executor is None:
+        cc.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='libvirt')
+
+    def call(func, *args):
+        return asyncio.wait_for(loop.run_in_executor(cc.executor, func, *args), cc.DOMAIN_TIMEOUT)
+
+    def task(dom, control_info, stats, conn=None):
+        instance = dom.name()
+        try:
+            cc.LAST_DOMAIN_STATS[instance] = collect_domain(libv_meta, dom, control_info, stats, conn)
+        finally:
+            cc.RUNNING_DOMAINS.discard(instance)
+
+    all_stats = []
+    instrumentation = libv_meta.instrumentation
+    instrumentation.begin_cycle()
+
+    try:
+        with instrumentation.phase('list'):
+            conn = instrumentation.wrap(await call(libv_meta.connection.get))
+            domains = await call(conn.listAllDomains, libv_meta.LIST_DOMAINS_RUNNING)
+            # Domain still running from previous cycle is not submitted again
+            timed_out = [dom.name() for dom in domains if dom.name() in cc.RUNNING_DOMAINS]
+            pending = [dom for dom in domains if dom.name() not in cc.RUNNING_DOMAINS]
+            # Job of a domain not answering in time is considered busy
+            control_info = dict(
+                (dom.name(), info if isinstance(info, tuple) else (4, -1)) for dom, info in zip(pending, (
+                    await asyncio.gather(*[call(get_control_info, dom) for dom in pending], return_exceptions=True))))
+        libv_meta.status = 0  # connected
+
+        chunk = libv_meta.STATS_CHUNK if libv_meta.STATS_CHUNK > 0 else max(-(-len(pending) // workers), 1)
+        chunks = [pending[i:i + chunk] for i in range(0, len(pending), chunk)]
+        with instrumentation.phase('stats'):
+            results = await asyncio.gather(*[
+                call(libv_meta.get_domain_stats, conn, part, control_info) for part in chunks
+            ], return_exceptions=True)
+
+        futures = {}
+        for part, domain_stats in zip(chunks, results):
+            for dom in part:
+                instance = dom.name()
+                if isinstance(domain_stats, dict):
+                    domain, stats = domain_stats.get(instance, (dom, None))
+                    retry = None
+                else:
+                    # Chunk missed its deadline, stats of the domain are requested alone
+                    domain, stats, retry = dom, None, conn
+                cc.RUNNING_DOMAINS.add(instance)
+                # Not cancelled on timeout, running domain is released by the task
+                futures[instance] = asyncio.wait_for(asyncio.shield(loop.run_in_executor(
+                    cc.executor, task, domain, control_info[instance], stats, retry)), cc.DOMAIN_TIMEOUT)
+        results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        timed_out.extend(
+            instance for instance, result in zip(futures, results) if isinstance(result, asyncio.TimeoutError))
+        all_stats.extend(export_last_stats(libv_meta, cc, domains, timed_out))
+
+        try:
+            with instrumentation.phase('gpu'):
+                items = await call(libv_meta.get_gpu_device_meta)
+            with instrumentation.phase('export'):
+                all_stats.extend(libv_meta.export(items, None, prefix='libv_'))
+        except Exception as e:
+            instrumentation.error('gpu_device')
+            print(e)
+    except Exception:
+        libv_meta.status = 1  # error
+        try:
+            await call(libv_meta.connection.check)
+        except Exception:
+            pass
+
+    cc.ALL_STATS = all_stats
+    with instrumentation.phase('render'):
+        await loop.run_in_executor(cc.executor, cc.render)
+    instrumentation.end_cycle()
 
 
 def shell(args):
@@ -390,9 +746,98 @@ def shell(args):
     embed(header="Welcome in iPython shell")
 
 
+def capture(args):
+    """Record libvirt calls of collection cycles into capture file."""
+    from prometheus_client import CollectorRegistry
+    from libvirtreplay import Recorder
+    libv_meta = LibvirtMetadata()
+    libv_meta.STATS_CHUNK = args.stats_chunk_size
+    libv_meta.INFO_METRIC = args.info_metric
+    recorder = Recorder()
+    libv_meta.instrumentation.recorder = recorder
+    libv_meta.load_libvirt_metadata()
+
+    registry = CollectorRegistry()
+    cc = CustomCollector('Libvirt instance stats',
+                         helper_name='libvirt', libv_meta=libv_meta, registry=registry)
+    cc.WORKERS = args.workers
+    cc.DOMAIN_TIMEOUT = args.domain_timeout
+    registry.register(cc)
+    for cycle in range(args.cycles):
+        if cycle:
+            time.sleep(args.wait_time)
+        prom_stats(libv_meta, cc)
+        print('Cycle {}: {} samples'.format(cycle + 1, cc.snapshot.samples))
+    if cc.executor:
+        cc.executor.shutdown(wait=True)
+    recorder.save(args.output, pci_path=libv_meta.PCI_DEVICES, cycles=args.cycles)
+    print('Recorded {} calls ({} distinct results) into {}'.format(
+        len(recorder.calls), len(recorder.values), args.output))
+
+
+def replay(args):
+    """Run collection cycles against calls recorded in capture file."""
+    import shutil
+    import tempfile
+    import instrumentation
+    import libvirtconnection
+    import libvirtmetadata
+    import libvirtreplay
+    from prometheus_client import CollectorRegistry
+    capture = libvirtreplay.load(args.capture, realtime=args.realtime)
+    libvirtreplay.install(libvirtmetadata, libvirtconnection, instrumentation)
+    root = tempfile.mkdtemp(prefix='libvirt-replay-')
+    try:
+        libv_meta = LibvirtMetadata()
+        libv_meta.STATS_CHUNK = args.stats_chunk_size
+        libv_meta.INFO_METRIC = args.info_metric
+        libv_meta.PCI_DEVICES = capture.create_pci_tree(root)
+        libv_meta.load_libvirt_metadata()
+
+        registry = CollectorRegistry()
+        cc = CustomCollector('Libvirt instance stats',
+                             helper_name='libvirt', libv_meta=libv_meta, registry=registry)
+        cc.WORKERS = args.workers
+        cc.DOMAIN_TIMEOUT = args.domain_timeout
+        registry.register(cc)
+        for cycle in range(args.cycles or capture.cycles or 1):
+            start = time.monotonic()
+            prom_stats(libv_meta, cc)
+            print('Cycle {}: {:.4f}s, {} samples'.format(
+                cycle + 1, time.monotonic() - start, cc.snapshot.samples))
+        if cc.executor:
+            cc.executor.shutdown(wait=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def stats_interval(value):
+    """Parse GROUP=SECONDS argument."""
+    groups = [group for group, flag, prefix in STATS_GROUPS]
+    try:
+        group, seconds = value.split('=', 1)
+        seconds = float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected GROUP=SECONDS, got {!r}'.format(value))
+    if group not in groups:
+        raise argparse.ArgumentTypeError('unknown stats group {!r}, choose from {}'.format(group, ', '.join(groups)))
+    return group, seconds
+
+
 def main(args):
     scheduler = Scheduler()
     libv_meta = LibvirtMetadata()
+    libv_meta.STATS_CHUNK = args.stats_chunk_size
+    libv_meta.INFO_METRIC = args.info_metric
+    libv_meta.STATS_INTERVALS.update(args.stats_intervals or [])
+    if args.collector == 'async':
+        libv_meta.connection.start_event_loop(scheduler.loop)
+        scheduler.log('Async collector, libvirt events dispatched by {}'.format(
+            'asyncio loop' if libv_meta.connection.event_impl == 'asyncio' else 'thread (libvirtaio not available)'))
+    else:
+        libv_meta.connection.start_event_loop()
+    # Reload metadata of domains changed by events when they arrive
+    libv_meta.on_domain_event.append(scheduler.add_triggered_task(libv_meta.process_domain_events))
     try:
         libv_meta.load_libvirt_metadata()
     except Exception:
@@ -400,18 +845,39 @@ def main(args):
 
     cc = CustomCollector('Libvirt instance stats',
                          helper_name='libvirt', libv_meta=libv_meta)
+    cc.WORKERS = args.workers
+    cc.DOMAIN_TIMEOUT = args.domain_timeout
+    cc.scheduler = scheduler
     REGISTRY.register(cc)
-    start_http_server(args.port, addr=args.addr)
+    cc.render()
+    collect = prom_stats_async if args.collector == 'async' else prom_stats
+    if args.on_demand:
+        if args.collector == 'async':
+            def collect_on_demand():
+                asyncio.run_coroutine_threadsafe(prom_stats_async(libv_meta, cc), scheduler.loop).result()
+        else:
+            def collect_on_demand():
+                prom_stats(libv_meta, cc)
+        cc.on_demand = OnDemand(collect_on_demand, ttl=args.ttl, timeout=args.request_timeout)
+    if args.http_server == 'thread':
+        start_snapshot_server(args.port, args.addr, cc, on_demand=cc.on_demand)
+    else:
+        server = SnapshotServer(
+            cc, max_connections=args.max_connections, timeout=args.request_timeout, on_demand=cc.on_demand)
+        scheduler.add_coroutine(server.serve(args.port, args.addr, unix_socket=args.unix_socket))
+        if args.unix_socket:
+            scheduler.log('Exposing metrics at: unix:{}'.format(args.unix_socket))
     scheduler.log(
         'Exposing metrics at: http://{}:{}/metrics'.format(args.addr, args.port))
 
-    # Every 'wait_time' seconds
+    # Every 'wait_time' seconds, unless scrapes trigger collection
+    if not args.on_demand:
+        scheduler.add_periodic_task(
+            collect, 'second', round=args.wait_time, args=(libv_meta, cc), overlap=args.overlap, name='prom_stats'
+        )
+    # Every hour, consistency sweep of all metadata
     scheduler.add_periodic_task(
-        prom_stats, 'second', round=args.wait_time, args=(libv_meta, cc)
-    )
-    # Every 20 minutes
-    scheduler.add_periodic_task(
-        libv_meta.load_libvirt_metadata, 'minute', round=20)
+        libv_meta.load_libvirt_metadata, 'hour', round=1, overlap='coalesce')
 
     scheduler.run_concurrent(debug=args.debug)
 
@@ -434,10 +900,82 @@ if __name__ == '__main__':
         '-t', '--wait-time', dest='wait_time', default=2, type=int,
         help='Time to sleep between measures [2-30]'
     )
+    parser.add_argument(
+        '--http-server', dest='http_server', default='asyncio', choices=['asyncio', 'thread'],
+        help='Serve metrics on the scheduler event loop (default) or from a server thread'
+    )
+    parser.add_argument(
+        '--unix-socket', dest='unix_socket', default=None,
+        help='Also expose metrics on UNIX socket (asyncio server only)'
+    )
+    parser.add_argument(
+        '--max-connections', dest='max_connections', default=64, type=int,
+        help='Open connections to metrics server, further are refused (asyncio server only)'
+    )
+    parser.add_argument(
+        '--request-timeout', dest='request_timeout', default=10, type=float,
+        help='Seconds to receive a request or keep an idle connection (asyncio server only), '
+             'also the longest wait of a scrape for on-demand collection'
+    )
+    parser.add_argument(
+        '--on-demand', dest='on_demand', action='store_true',
+        help='Collect on scrape when the snapshot is older than --ttl instead of every --wait-time seconds'
+    )
+    parser.add_argument(
+        '--ttl', dest='ttl', default=10, type=float,
+        help='Seconds a snapshot is served without collection in on-demand mode (default: 10)'
+    )
+    parser.add_argument(
+        '--stats-chunk-size', dest='stats_chunk_size', default=0, type=int,
+        help='Domains per bulk stats call (default 0: all domains in one call)'
+    )
+    parser.add_argument(
+        '--stats-interval', dest='stats_intervals', action='append', type=stats_interval, metavar='GROUP=SECONDS',
+        help='Refresh interval of a stats group (state, cpu_total, balloon, vcpu, interface, block), '
+             '0 for every collection (default: block=15, others 0); repeat for more groups'
+    )
+    parser.add_argument(
+        '--info-metric', dest='info_metric', action='store_true',
+        help='Export instance labels on libv_domain_info only, other series carry uuid'
+    )
+    parser.add_argument(
+        '--overlap', dest='overlap', default='skip', choices=['skip', 'coalesce'],
+        help='Policy for a collection still in progress when the next one is due (default: skip)'
+    )
+    parser.add_argument(
+        '--workers', dest='workers', default=0, type=int,
+        help='Collect domains in parallel by given number of workers (default 0: sequential bulk collection), '
+             'libvirt call workers of async collector (default 0: 4 workers)'
+    )
+    parser.add_argument(
+        '--collector', dest='collector', default='thread', choices=['thread', 'async'],
+        help='Collect in executor thread (default) or on the event loop awaiting libvirt calls, '
+             'libvirt events are dispatched by the loop using libvirtaio'
+    )
+    parser.add_argument(
+        '--domain-timeout', dest='domain_timeout', default=10, type=float,
+        help='Deadline of parallel domain collection in seconds, last known stats are exported after it'
+    )
     parser.add_argument('--debug', dest='debug',
                         action='store_true', help='Debug messages')
     subparsers.add_parser(
         'shell', help='Run iPython shell').set_defaults(func=shell)
+    capture_parser = subparsers.add_parser(
+        'capture', help='Record libvirt calls of collection cycles for replay')
+    capture_parser.add_argument(
+        '-n', '--cycles', dest='cycles', default=10, type=int, help='Number of collection cycles')
+    capture_parser.add_argument(
+        '-o', '--output', dest='output', default='libvirt-capture.json.gz', help='Capture file')
+    capture_parser.set_defaults(func=capture)
+    replay_parser = subparsers.add_parser(
+        'replay', help='Run collection cycles against recorded libvirt calls')
+    replay_parser.add_argument('capture', help='Capture file')
+    replay_parser.add_argument(
+        '-n', '--cycles', dest='cycles', default=0, type=int,
+        help='Number of collection cycles (default 0: as captured)')
+    replay_parser.add_argument(
+        '--realtime', dest='realtime', action='store_true', help='Replay calls with recorded latency')
+    replay_parser.set_defaults(func=replay)
 
     args = parser.parse_args()
     args.func(args)
@@ -0,0 +1,194 @@
+"""
+Libvirt connection
+==================
+
+Persistent readonly connection to libvirt shared between threads.
+
+.. code-block:: python
+
+    from libvirtconnection import LibvirtConnection
+
+    connection = LibvirtConnection()
+    connection.start_event_loop()
+
+    conn = connection.get()
+    conn.listAllDomains()
+
+Event loop has to be started before the first connection is opened,
+keepalive, close callbacks and domain events rely on it. Without event
+loop a dead connection is detected by `isAlive` only. Given an asyncio
+loop, libvirt events are dispatched by that loop (libvirtaio) instead of
+a thread:
+
+.. code-block:: python
+
+    connection.start_event_loop(scheduler.loop)
+
+Callbacks in `on_connect` are called with every newly opened connection,
+e.g. to register domain events again after reconnect.
+"""
+import threading
+import time
+
+try:
+    import libvirt
+except Exception:
+    libvirt = None
+
+
+class LibvirtConnection:
+    """
+    Libvirt connection manager.
+
+    Keeps one readonly connection to libvirt open and shares it between
+    threads. Dead connection is dropped and reopened on next use, failed
+    attempts are retried with exponential backoff.
+    """
+
+    def __init__(self, uri=None, keepalive_interval=5, keepalive_count=3, backoff_min=1, backoff_max=60):
+        """
+        :param str uri: libvirt URI (default: None - local hypervisor)
+        :param int keepalive_interval: seconds between keepalive messages
+        :param int keepalive_count: unanswered keepalive messages before closing
+        :param int backoff_min: first delay after failed connection (seconds)
+        :param int backoff_max: longest delay between connection attempts (seconds)
+        """
+        self.uri = uri
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.connected_at = None  # monotonic time of last handshake
+        self.handshake_time = 0.0  # seconds
+        self.reconnects = 0
+        self.failures = 0
+        self.event_loop = False
+        self.event_impl = None  # 'asyncio' or 'thread'
+        self.on_connect = []
+        self.__conn = None
+        self.__closed = False
+        self.__retry_at = 0
+        self.__lock = threading.Lock()
+
+    def start_event_loop(self, loop=None):
+        """
+        Run libvirt event loop.
+
+        Events are dispatched by asyncio `loop` when given and libvirtaio
+        is available, otherwise default event loop runs in a daemon thread.
+        Has to be called before the first connection is opened.
+
+        :param loop: asyncio event loop (optional)
+        """
+        if self.event_loop:
+            return
+        if loop is not None:
+            try:
+                import libvirtaio
+                libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+                self.event_loop = True
+                self.event_impl = 'asyncio'
+                return
+            except Exception:
+                pass
+
+        def run_event_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=run_event_loop, name='libvirt-event-loop', daemon=True).start()
+        self.event_loop = True
+        self.event_impl = 'thread'
+
+    def get(self):
+        """
+        Return open connection to libvirt.
+
+        Connection is (re)opened when missing or dead.
+
+        :raises libvirt.libvirtError: when connection cannot be opened
+        """
+        conn = self.__conn
+        if self.__alive(conn):
+            return conn
+        with self.__lock:
+            if self.__alive(self.__conn):
+                return self.__conn
+            self.__drop()
+            return self.__open()
+
+    def check(self):
+        """Drop connection if it is not alive anymore."""
+        with self.__lock:
+            if self.__conn is not None and not self.__alive(self.__conn):
+                self.__drop()
+
+    def close(self):
+        """Close the connection."""
+        with self.__lock:
+            self.__drop()
+
+    @property
+    def age(self):
+        """Age of the open connection in seconds (0 if closed)."""
+        if self.__conn is None or self.connected_at is None:
+            return 0
+        return time.monotonic() - self.connected_at
+
+    def __open(self):
+        if time.monotonic() < self.__retry_at:
+            raise libvirt.libvirtError('Libvirt reconnect postponed for {:.1f}s'.format(
+                self.__retry_at - time.monotonic()))
+        start = time.monotonic()
+        try:
+            conn = libvirt.openReadOnly(self.uri)
+            if conn is None:
+                raise libvirt.libvirtError('Failed to open connection to libvirt')
+        except libvirt.libvirtError:
+            self.failures += 1
+            self.__retry_at = time.monotonic() + min(
+                self.backoff_max, self.backoff_min * 2 ** (self.failures - 1))
+            raise
+        self.handshake_time = time.monotonic() - start
+        if self.connected_at is not None:
+            self.reconnects += 1
+        self.connected_at = time.monotonic()
+        self.failures = 0
+        self.__retry_at = 0
+        self.__closed = False
+        if self.event_loop:
+            try:
+                conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+                conn.registerCloseCallback(self.__close_callback, None)
+            except libvirt.libvirtError:
+                pass
+        for callback in self.on_connect:
+            try:
+                callback(conn)
+            except Exception:
+                pass
+        self.__conn = conn
+        return conn
+
+    def __alive(self, conn):
+        try:
+            return conn is not None and not self.__closed and conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def __drop(self):
+        conn, self.__conn = self.__conn, None
+        if conn is None:
+            return
+        try:
+            if self.event_loop:
+                conn.unregisterCloseCallback()
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def __close_callback(self, conn, reason, opaque):
+        """Mark connection closed by libvirt, it is reopened on next use."""
+        if self.__conn is conn:
+            self.__closed = True
@@ -23,12 +23,25 @@ Includes VM info held by libvirt and statistics.
 
     libv_meta.get_gpu_devices(domain)
 
+Instance registry `LIBVIRT_INSTANCES` is a read-only mapping of read-only
+metadata. Updates build a new mapping and replace the reference, readers
+never lock and always see a complete registry. Deleted domains are evicted
+on full reload and undefine events, entries expire after `INSTANCE_TTL` and
+the registry is bounded by `MAX_INSTANCES`.
 """
 import re
+import sys
+import threading
+import time
 import uuid
 import xml.etree.ElementTree as ET
+from collections.abc import Mapping
 from contextlib import contextmanager
-from pcimetadata import get_pci_devices
+from types import MappingProxyType
+from instrumentation import Instrumentation
+from libvirtconnection import LibvirtConnection
+from pcimetadata import SYSFS_PCI_DEVICES
+from pcimetadata import get_pci_inventory
 
 try:
     import libvirt
@@ -40,6 +53,306 @@ try:
 except Exception:
     NOVA_NS = "http://openstack.org/xmlns/libvirt/nova/1.1"
 
+# Stats groups consumed by extractors: (group, libvirt flag, key prefix)
+STATS_GROUPS = [
+    ('state', 'VIR_DOMAIN_STATS_STATE', 'state'),
+    ('cpu_total', 'VIR_DOMAIN_STATS_CPU_TOTAL', 'cpu'),
+    ('balloon', 'VIR_DOMAIN_STATS_BALLOON', 'balloon'),
+    ('vcpu', 'VIR_DOMAIN_STATS_VCPU', 'vcpu'),
+    ('interface', 'VIR_DOMAIN_STATS_INTERFACE', 'net'),
+    ('block', 'VIR_DOMAIN_STATS_BLOCK', 'block'),
+]
+
+
+class DomainDefinition:
+    """
+    Domain definition
+
+    Parts of domain XML used by metadata extractors. Parsed once
+    and cached by domain UUID.
+    """
+
+    __slots__ = (
+        'fingerprint', 'loaded', 'cpu_model', 'cpu_fallback', 'cpu_features', 'hostdevs', 'disks', 'interfaces')
+
+    def __init__(self, fingerprint=None):
+        self.fingerprint = fingerprint
+        self.loaded = time.monotonic()
+        self.cpu_model = None
+        self.cpu_fallback = 0
+        self.cpu_features = []  # [(name, required)]
+        self.hostdevs = {}  # pci address -> hostdev info
+        self.disks = []  # [{'source': {}, 'hosts': [], 'auth': {}, 'driver': {}, 'target': {}}]
+        self.interfaces = []  # [target device]
+
+
+class DomainDefinitionParser:
+    """
+    Domain definition parser
+
+    Parser target filling `DomainDefinition` in a single pass over domain
+    XML. No element tree is built, only attributes of `<cpu>`, `<hostdev>`,
+    `<disk>` and `<interface>` devices are kept, other elements are dropped
+    as they are read.
+
+    .. code-block:: python
+
+        parser = ET.XMLParser(target=DomainDefinitionParser(definition))
+        parser.feed(xml_string)
+        parser.close()
+    """
+
+    __slots__ = ('definition', 'level', 'device', 'depth', 'source', 'info', 'text', 'cpu_done')
+    DEVICES = frozenset(['cpu', 'hostdev', 'disk', 'interface'])
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.level = 0  # depth of current element
+        self.device = None  # tag of device being read
+        self.depth = 0  # depth of device being read
+        self.source = False  # reading direct <source> child of device
+        self.info = None
+        self.text = None  # text of CPU model being read
+        self.cpu_done = False
+
+    def start(self, tag, attrib):
+        self.level += 1
+        device = self.device
+        if device is None:
+            if tag in self.DEVICES and not (tag == 'cpu' and self.cpu_done):
+                self.device = tag
+                self.depth = self.level
+                if tag == 'hostdev':
+                    self.info = {'type': attrib.get('type')}
+                elif tag == 'disk':
+                    self.info = {'source': None, 'hosts': [], 'auth': None, 'driver': None, 'target': None}
+                elif tag == 'interface':
+                    self.info = {}
+            return
+        child = self.level == self.depth + 1
+        if child and tag == 'source':
+            self.source = True
+        grandchild = self.source and self.level == self.depth + 2
+        if device == 'cpu':
+            if tag == 'feature':
+                self.definition.cpu_features.append(
+                    (attrib.get('name'), 1 if (attrib.get('policy') == 'require') else 0))
+            elif tag == 'model' and self.text is None and self.definition.cpu_model is None:
+                self.definition.cpu_fallback = 1 if (attrib.get('fallback') == 'allow') else 0
+                self.text = []
+        elif device == 'hostdev':
+            if child and tag in ('alias', 'driver') and tag not in self.info:
+                self.info[tag] = attrib.get('name')
+            elif grandchild and tag == 'address' and 'address' not in self.info:
+                self.info['address'] = dict(attrib)
+        elif device == 'disk':
+            if child and tag in self.info and self.info[tag] is None:
+                self.info[tag] = dict(attrib)
+            elif grandchild and tag == 'host':
+                self.info['hosts'].append(dict(attrib))
+        elif device == 'interface':
+            if child and tag == 'target' and 'target' not in self.info:
+                self.info['target'] = attrib.get('dev')
+
+    def end(self, tag):
+        if self.device is not None:
+            if self.text is not None and tag == 'model':
+                self.definition.cpu_model = ''.join(self.text) or None
+                self.text = None
+            elif self.level == self.depth:
+                self.end_device()
+            elif self.level == self.depth + 1 and tag == 'source':
+                self.source = False
+        self.level -= 1
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end_device(self):
+        device, info = self.device, self.info
+        self.device = None
+        self.info = None
+        if device == 'cpu':
+            self.cpu_done = True
+        elif device == 'hostdev':
+            address = info.get('address')
+            try:
+                key = '{}:{}:{}.{}'.format(
+                    address.get('domain')[2:],
+                    address.get('bus')[2:],
+                    address.get('slot')[2:],
+                    address.get('function')[2:])
+            except Exception:
+                return
+            self.definition.hostdevs[key] = dict(
+                type=info['type'],
+                alias=info.get('alias') or 'hostdev',
+                driver=info.get('driver') or 'unknown',
+                pci_domain=address.get('domain', 'unknown'),
+                bus=address.get('bus', 'unknown'),
+                slot=address.get('slot', 'unknown'),
+                function=address.get('function', 'unknown'),
+            )
+        elif device == 'disk':
+            self.definition.disks.append(info)
+        elif device == 'interface' and info.get('target'):
+            self.definition.interfaces.append(info['target'])
+
+    def close(self):
+        return self.definition
+
+
+class InstanceRecord(Mapping):
+    """
+    Instance metadata
+
+    Read-only mapping of instance labels (domain, uuid, name, project),
+    missing labels are left out.
+    """
+
+    __slots__ = ('domain', 'uuid', 'name', 'project', 'loaded')
+    FIELDS = ('domain', 'uuid', 'name', 'project')
+
+    def __init__(self, domain=None, uuid=None, name=None, project=None):
+        set_attr = object.__setattr__
+        set_attr(self, 'domain', domain)
+        set_attr(self, 'uuid', uuid)
+        set_attr(self, 'name', name)
+        set_attr(self, 'project', sys.intern(project) if project else project)
+        set_attr(self, 'loaded', time.monotonic())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('InstanceRecord is read-only')
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return (key for key in self.FIELDS if getattr(self, key) is not None)
+
+    def __len__(self):
+        return sum(1 for key in self.FIELDS if getattr(self, key) is not None)
+
+    def __repr__(self):
+        return 'InstanceRecord({})'.format(dict(self))
+
+
+class DomainStats:
+    """
+    Domain stats
+
+    Stats of a domain merged from stats groups fetched at different
+    intervals. Keys of a group are replaced together, merged stats are
+    a new dict on every merge.
+    """
+
+    __slots__ = ('stats', 'fetched')
+
+    def __init__(self):
+        self.stats = {}
+        self.fetched = {}  # key prefix -> monotonic time
+
+
+class DomainQuarantine:
+    """
+    Domain quarantine
+
+    Tracks latency and failures of per-domain stats calls. Misbehaving
+    domain (failed or slow stats call, domain job busy for too long) is
+    moved to a slow lane: it is left out of bulk stats calls and probed
+    alone once its backoff expires. Backoff grows exponentially with every
+    further misbehaviour, healthy probe releases the domain.
+
+    Bulk call is slow when it exceeds `latency` over the usual per-domain
+    cost of bulk calls (`cost`, learned from calls which were not slow).
+    """
+
+    def __init__(self, latency=1.0, busy=5, backoff_min=30, backoff_max=900, probes=12):
+        """
+        :param float latency: slowest acceptable stats call of a domain (seconds)
+        :param int busy: longest acceptable domain job (seconds)
+        :param int backoff_min: first quarantine period (seconds)
+        :param int backoff_max: longest quarantine period (seconds)
+        :param int probes: most calls made to find slow domain of a bulk call
+        """
+        self.latency = latency
+        self.busy = busy
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.probes = probes
+        self.cost = 0.0  # usual seconds per domain of bulk calls
+        self.domains = {}  # name -> [level, release time, last latency]
+
+    def quarantined(self, name):
+        """Whether domain is in the slow lane."""
+        return name in self.domains and self.domains[name][0] > 0
+
+    def admit(self, name):
+        """Whether stats of the domain may be requested now."""
+        entry = self.domains.get(name)
+        return entry is None or time.monotonic() >= entry[1]
+
+    def level(self, name):
+        """Quarantine level of the domain (0: healthy)."""
+        return self.domains.get(name, (0,))[0]
+
+    def observe(self, name, latency=None, failed=False):
+        """
+        Record outcome of a stats call of the domain.
+
+        :param str name: domain name
+        :param float latency: duration of the call (seconds)
+        :param bool failed: call failed or was not made
+        """
+        entry = self.domains.setdefault(name, [0, 0, 0.0])
+        if latency is not None:
+            entry[2] = latency
+        if failed or (latency is not None and latency > self.latency):
+            entry[0] += 1
+            entry[1] = time.monotonic() + min(self.backoff_max, self.backoff_min * 2 ** (entry[0] - 1))
+        elif latency is not None:
+            # Outcome without latency does not prove the domain healthy
+            entry[0] = 0
+            entry[1] = 0
+
+    def slow(self, latency, count):
+        """Whether bulk call of `count` domains took too long."""
+        return latency > self.latency + 2 * self.cost * count
+
+    def learn(self, latency, count):
+        """Update usual per-domain cost by bulk call which was not slow."""
+        cost = latency / max(count, 1)
+        self.cost = cost if not self.cost else 0.8 * self.cost + 0.2 * cost
+
+    def check_control(self, name, control_info, nowait=False):
+        """
+        Quarantine domain with job busy for too long.
+
+        Busy job does not block stats calls made with NOWAIT, then only
+        domain not answering control info is quarantined.
+
+        :param str name: domain name
+        :param tuple control_info: control state and time (seconds)
+        :param bool nowait: stats are requested with NOWAIT flag
+
+        :return bool: domain is busy
+        """
+        control_state, control_time = control_info
+        if control_time < 0 or (not nowait and control_state != 0 and control_time >= self.busy):
+            self.observe(name, failed=True)
+            return True
+        return False
+
+    def prune(self, names):
+        """Forget domains not in `names`."""
+        for name in list(self.domains.keys()):
+            if name not in names:
+                self.domains.pop(name, None)
+
 
 class LibvirtMetadata:
     """
@@ -49,48 +362,394 @@ class LibvirtMetadata:
     Class is intended to be shared between exporters for compute nodes.
     """
 
-    def __init__(self, xmlns=NOVA_NS):
+    def __init__(self, xmlns=NOVA_NS, connection=None, instrumentation=None):
         self.uuidp = re.compile(
             '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.I)
+        # Refresh interval of stats groups in seconds (0: every collection)
+        self.STATS_INTERVALS = {
+            'state': 0, 'cpu_total': 0, 'balloon': 0, 'vcpu': 0, 'interface': 0, 'block': 15,
+        }
+        self.STATS_GROUPS = [
+            (group, getattr(libvirt, flag), prefix) for group, flag, prefix in STATS_GROUPS if hasattr(libvirt, flag)]
         self.STATS = 0
+        for group, flag, prefix in self.STATS_GROUPS:
+            self.STATS |= flag
+        self.DOMAIN_STATS = {}  # domain name -> DomainStats
+        self.STATS_CHUNK = 0  # domains per bulk stats call (0: all at once)
         self.FLAGS = libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING
+        # Do not wait for domain job lock, stats requiring it are skipped
+        self.FLAGS_NOWAIT = getattr(libvirt, 'VIR_CONNECT_GET_ALL_DOMAINS_STATS_NOWAIT', 0)
+        self.FLAGS |= self.FLAGS_NOWAIT
+        self.QUARANTINE = DomainQuarantine()
         self.LIST_DOMAINS_RUNNING = libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING
         self.DOMAIN_RUNNING = libvirt.VIR_DOMAIN_RUNNING
-        self.LIBVIRT_INSTANCES = {}
+        self.LIBVIRT_INSTANCES = MappingProxyType({})  # replaced on update, see `update_instances`
+        self.INSTANCE_TTL = 7200  # seconds, expired entries are reloaded on use
+        self.MAX_INSTANCES = 10000  # oldest entries are evicted above
+        self.INSTANCE_EVICTIONS = {'deleted': 0, 'expired': 0, 'capacity': 0}
+        self.DOMAIN_DEFINITIONS = {}
+        self.DEFINITION_TTL = 300  # seconds
+        self.DEVICE_META_INTERVAL = 300  # seconds
+        self.INFO_METRIC = False  # instance labels only on domain_info
+        self.PCI_DEVICES = SYSFS_PCI_DEVICES
+        self.LABEL_SETS = {}  # instance -> (metadata, info metric, {sub-labels: (names, values)})
         self.xmlns = xmlns
         self.status = -1  # uninitialized
+        self.connection = connection or LibvirtConnection()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.connection.on_connect.append(self.register_domain_events)
+        self.DOMAIN_EVENTS = [getattr(libvirt, event_id) for event_id in [
+            'VIR_DOMAIN_EVENT_ID_LIFECYCLE',
+            'VIR_DOMAIN_EVENT_ID_METADATA_CHANGE',
+            'VIR_DOMAIN_EVENT_ID_DEVICE_ADDED',
+            'VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED',
+        ] if hasattr(libvirt, event_id)]
+        self.__events_lock = threading.Lock()
+        self.__instances_lock = threading.Lock()
+        self.__pending_domains = {}
+        self.__pending_reload = False
+        self.__device_meta = None  # (monotonic time, items)
+        self.on_domain_event = []  # callbacks notified when events wait for `process_domain_events`
 
     @contextmanager
     def libvirt_connection(self):
-        """Yield readonly connection to libvirt."""
+        """Yield shared readonly connection to libvirt (instrumented)."""
         try:
-            conn = libvirt.openReadOnly(None)
-            try:
-                if conn:
-                    yield conn
-                    self.status = 0  # connected
-            finally:
-                conn.close()
+            yield self.instrumentation.wrap(self.connection.get())
+            self.status = 0  # connected
         except libvirt.libvirtError:
             self.status = 1  # error
+            self.connection.check()
+
+    def register_domain_events(self, conn):
+        """
+        Register domain event callbacks on a new connection.
+
+        Events only mark domains for reload, metadata are loaded by
+        `process_domain_events`, callbacks in `on_domain_event` are notified
+        to run it. Full reload follows every (re)connect as events could have
+        been missed meanwhile.
+
+        :param conn: libvirt connection
+        """
+        if not self.connection.event_loop:
+            return
+        with self.__events_lock:
+            self.__pending_reload = True
+        self.__notify_events()
+        for event_id in self.DOMAIN_EVENTS:
+            callback = self._lifecycle_event if (
+                event_id == libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE) else self._domain_event
+            try:
+                conn.domainEventRegisterAny(None, event_id, callback, None)
+            except libvirt.libvirtError:
+                pass
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        if event != libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self._domain_event(conn, domain)
+        else:
+            self.DOMAIN_DEFINITIONS.pop(domain.UUIDString(), None)
+            self.__device_meta = None
+            with self.__events_lock:
+                self.__pending_domains[domain.name()] = None  # evict
+            self.__notify_events()
+
+    def _domain_event(self, conn, domain, *args):
+        self.DOMAIN_DEFINITIONS.pop(domain.UUIDString(), None)
+        self.__device_meta = None
+        with self.__events_lock:
+            self.__pending_domains[domain.name()] = domain
+        self.__notify_events()
+
+    def __notify_events(self):
+        for callback in self.on_domain_event:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def process_domain_events(self):
+        """
+        Reload metadata of domains changed since the last call.
+
+        Intended to run when notified by `on_domain_event`, no libvirt
+        calls are made unless domain events were received.
+        """
+        with self.__events_lock:
+            pending, self.__pending_domains = self.__pending_domains, {}
+            reload = self.__pending_reload
+        if reload:
+            self.load_libvirt_metadata()
+            return
+        updates = {}
+        deleted = []
+        for instance, domain in pending.items():
+            if domain is None:
+                deleted.append(instance)
+                continue
+            metadata = self.load_instance_metadata(domain)
+            if metadata:
+                updates[instance] = metadata
+        self.update_instances(updates, deleted=deleted)
+
+    def update_instances(self, updates, deleted=(), replace=False):
+        """
+        Publish metadata of instances in a new registry.
+
+        Registry is copied with `updates` applied and swapped in, readers
+        keep using the registry they already got. Deleted and expired
+        entries are evicted, oldest entries above `MAX_INSTANCES` as well.
+
+        :param dict updates: instance -> metadata
+        :param list deleted: instances of deleted domains
+        :param bool replace: `updates` hold all existing domains, others are deleted
+        """
+        if not updates and not deleted and not replace:
+            return
+        now = time.monotonic()
+        with self.__instances_lock:
+            instances = dict(self.LIBVIRT_INSTANCES)
+            evictions = dict((reason, 0) for reason in self.INSTANCE_EVICTIONS)
+            for instance in list(instances) if replace else deleted:
+                if instance not in updates and instances.pop(instance, None) is not None:
+                    evictions['deleted'] += 1
+            instances.update(updates)
+            for instance, metadata in list(instances.items()):
+                if now - getattr(metadata, 'loaded', now) >= self.INSTANCE_TTL:
+                    del instances[instance]
+                    evictions['expired'] += 1
+            if len(instances) > self.MAX_INSTANCES:
+                oldest = sorted(instances, key=lambda instance: getattr(instances[instance], 'loaded', now))
+                for instance in oldest[:len(instances) - self.MAX_INSTANCES]:
+                    del instances[instance]
+                    evictions['capacity'] += 1
+            self.LIBVIRT_INSTANCES = MappingProxyType(instances)
+            for reason, count in evictions.items():
+                self.INSTANCE_EVICTIONS[reason] += count
+        for instance in list(self.LABEL_SETS.keys()):
+            if instance not in instances:
+                self.LABEL_SETS.pop(instance, None)
+
+    def get_domain_stats(self, conn, domains, control_info=None):
+        """
+        Get stats of domains using bulk calls.
+
+        Domains are requested in chunks of `STATS_CHUNK` (all in one call
+        when 0). Domains missing in the bulk result, or in a chunk that failed,
+        fall back to a per-domain call if they are still running.
+
+        Domains with a busy job or with failed/slow stats calls are moved
+        to the slow lane of `QUARANTINE`, see `DomainQuarantine`. Slow
+        bulk call is searched for its slow domain. Busy job quarantines the
+        domain only without NOWAIT.
+
+        Only stats groups due by `STATS_INTERVALS` are requested, domains
+        are batched by due groups. Returned stats are merged with groups
+        fetched before, see `merge_stats`.
+
+        :param conn: libvirt connection
+        :param list domains: libvirt domains
+        :param dict control_info: domain name -> (control state, control time)
+
+        :return dict: domain name -> (domain, stats)
+        """
+        results = {}
+        bulk = {}  # due stats groups -> domains
+        now = time.monotonic()
+        for domain in domains:
+            name = domain.name()
+            if not self.QUARANTINE.admit(name):
+                continue
+            if control_info and name in control_info and self.QUARANTINE.check_control(
+                    name, control_info[name], nowait=self.nowait):
+                continue
+            if not self.QUARANTINE.quarantined(name):
+                due = self.stats_due(name, now)
+                if due is None:
+                    results[name] = (domain, self.DOMAIN_STATS[name].stats)
+                else:
+                    bulk.setdefault(due, []).append(domain)
+
+        probes = [self.QUARANTINE.probes]
+        for due, batch in bulk.items():
+            chunk = self.STATS_CHUNK if self.STATS_CHUNK > 0 else max(len(batch), 1)
+            for i in range(0, len(batch), chunk):
+                self.__bulk_stats(conn, batch[i:i + chunk], due, results, probes)
+
+        for domain in domains:
+            name = domain.name()
+            if name in results or not self.QUARANTINE.admit(name):
+                continue
+            if control_info and name in control_info and control_info[name][1] < 0:
+                continue
+            start = time.monotonic()
+            try:
+                if int(domain.state()[0]) != self.DOMAIN_RUNNING:
+                    continue
+                # Probe of a single domain requests all groups
+                for dom, stats in conn.domainListGetStats(
+                        [domain], stats=self.STATS, flags=self.FLAGS):
+                    results[dom.name()] = (dom, self.merge_stats(dom.name(), stats, start))
+                self.QUARANTINE.observe(name, latency=time.monotonic() - start, failed=name not in results)
+            except Exception as e:
+                self.__check_nowait(e)
+                self.QUARANTINE.observe(name, latency=time.monotonic() - start, failed=True)
+
+        # Stats of stopped or skipped domains are fetched whole next time
+        for domain in domains:
+            if domain.name() not in results:
+                self.DOMAIN_STATS.pop(domain.name(), None)
+        return results
+
+    def __bulk_stats(self, conn, domains, due, results, probes):
+        """
+        Get stats of domains in one bulk call.
+
+        Latency of the call is shared by its domains. Slow call (see
+        `DomainQuarantine.slow`) is searched for its slow domain, see
+        `__find_slow`.
+
+        :param conn: libvirt connection
+        :param list domains: libvirt domains
+        :param int due: stats groups flags
+        :param dict results: domain name -> (domain, stats), updated
+        :param list probes: calls left for the search, updated
+        """
+        start = time.monotonic()
+        try:
+            chunk_stats = conn.domainListGetStats(domains, stats=due, flags=self.FLAGS)
+        except libvirt.libvirtError as e:
+            self.__check_nowait(e)
+            return
+        latency = time.monotonic() - start
+        for domain, stats in chunk_stats:
+            results[domain.name()] = (domain, self.merge_stats(domain.name(), stats, start))
+        if not self.QUARANTINE.slow(latency, len(domains)):
+            self.QUARANTINE.learn(latency, len(domains))
+            for domain, stats in chunk_stats:
+                self.QUARANTINE.observe(domain.name(), latency=latency / len(chunk_stats))
+            return
+        slow = self.__find_slow(conn, domains, due, probes)
+        if slow is None:
+            return  # not attributed, levels are kept
+        slow_domain, slow_latency = slow
+        self.QUARANTINE.observe(slow_domain.name(), latency=slow_latency)
+        for domain, stats in chunk_stats:
+            if domain.name() != slow_domain.name():
+                self.QUARANTINE.observe(
+                    domain.name(), latency=max(latency - slow_latency, 0) / max(len(chunk_stats) - 1, 1))
+
+    def __find_slow(self, conn, domains, due, probes):
+        """
+        Find slow domain of a slow bulk call.
+
+        Stats were received already, calls are only timed. First half of the
+        domains is timed, search continues in the half which is slow (the
+        other one when the first is not), the last domain left is timed
+        alone to confirm. At most `probes[0]` calls are made.
+
+        :return tuple: (domain, latency) or None if not found
+        """
+        while len(domains) > 1 and probes[0] > 0:
+            half = domains[:len(domains) // 2]
+            latency = self.__time_stats(conn, half, due, probes)
+            if latency is None:
+                return None
+            if self.QUARANTINE.slow(latency, len(half)):
+                if len(half) == 1:
+                    return half[0], latency
+                domains = half
+            else:
+                self.QUARANTINE.learn(latency, len(half))
+                domains = domains[len(domains) // 2:]
+        if len(domains) == 1 and probes[0] > 0:
+            latency = self.__time_stats(conn, domains, due, probes)
+            if latency is not None and self.QUARANTINE.slow(latency, 1):
+                return domains[0], latency
+        return None
+
+    def __time_stats(self, conn, domains, due, probes):
+        """Time bulk call of `domains`, None if failed."""
+        probes[0] -= 1
+        start = time.monotonic()
+        try:
+            conn.domainListGetStats(domains, stats=due, flags=self.FLAGS)
+        except libvirt.libvirtError as e:
+            self.__check_nowait(e)
+            return None
+        return time.monotonic() - start
+
+    def stats_due(self, name, now):
+        """
+        Get stats groups of domain due by `STATS_INTERVALS`.
+
+        :param str name: domain name
+        :param float now: monotonic time
+
+        :return int: stats groups flags (None: none due)
+        """
+        record = self.DOMAIN_STATS.get(name)
+        if record is None or not self.STATS_GROUPS:
+            return self.STATS
+        due = 0
+        for group, flag, prefix in self.STATS_GROUPS:
+            fetched = record.fetched.get(prefix)
+            if fetched is None or now - fetched >= self.STATS_INTERVALS.get(group, 0):
+                due |= flag
+        return due or None
+
+    def merge_stats(self, name, stats, fetched):
+        """
+        Merge fetched stats groups with groups of domain fetched before.
+
+        Groups present in `stats` replace all their previous keys, so a merged
+        group is never mixed from two calls.
+
+        :param str name: domain name
+        :param dict stats: stats returned by libvirt
+        :param float fetched: monotonic time of the call
+
+        :return dict: merged stats
+        """
+        record = self.DOMAIN_STATS.get(name)
+        if record is None:
+            record = self.DOMAIN_STATS[name] = DomainStats()
+        prefixes = set(key.split('.', 1)[0] for key in stats)
+        merged = dict((key, value) for key, value in record.stats.items() if key.split('.', 1)[0] not in prefixes)
+        merged.update(stats)
+        for prefix in prefixes:
+            record.fetched[prefix] = fetched
+        record.stats = merged
+        return merged
+
+    @property
+    def nowait(self):
+        """Whether stats are requested with NOWAIT flag."""
+        return bool(self.FLAGS & self.FLAGS_NOWAIT)
+
+    def __check_nowait(self, error):
+        """Stop using NOWAIT flag if libvirt does not support it."""
+        if self.FLAGS & self.FLAGS_NOWAIT and isinstance(error, libvirt.libvirtError) and \
+                error.get_error_code() in (libvirt.VIR_ERR_INVALID_ARG, libvirt.VIR_ERR_NO_SUPPORT):
+            self.FLAGS &= ~self.FLAGS_NOWAIT
 
     def _load_xml_tree(self, tree):
         """
         Load XML tree into dict.
 
+        Element is loaded as dict of its attributes and direct children by
+        tag (the last of repeated tags wins), text of element with attributes
+        as 'value'. Element with text only is loaded as the text, empty
+        element as ''. Every element is visited once.
+
         :param tree: libvirt XML tree (xml.etree.ElementTree),
 
         :return dict: parsed data
         """
-        data = {}
-        if tree.keys():
-            data = dict(tree.items())
-        if hasattr(tree, 'iter') and len(tree):
-            for item in tree.iter():
-                if item != tree:
-                    data[item.tag] = self._load_xml_tree(item)
-        elif hasattr(tree, 'getchildren') and tree.getchildren():
-            for item in tree.getchildren():
+        data = dict(tree.attrib)
+        if len(tree):
+            for item in tree:
                 data[item.tag] = self._load_xml_tree(item)
         elif tree.text and tree.text.strip():
             if data:
@@ -121,14 +780,14 @@ class LibvirtMetadata:
             tree = ET.fromstring(xml_string)
             data = self._load_xml_tree(tree)
         except Exception:
-            pass
+            self.instrumentation.error('instance_metadata')
         return data
 
     def load_instance_metadata(self, domain):
         """
         Load instance metadata data using libvirt domain.
 
-        Returns dict of metadata for domain (domain name, uuid, nova name, project name).
+        Returns `InstanceRecord` of domain (domain name, uuid, nova name, project name).
         """
         metadata = {}
         try:
@@ -141,8 +800,8 @@ class LibvirtMetadata:
             metadata['project'] = data.get('owner', {}).get(
                 'project', {}).get('value', 'unknown')
         except Exception:
-            pass
-        return metadata
+            self.instrumentation.error('instance_metadata')
+        return InstanceRecord(**metadata)
 
     def get_libvirt_metadata(self, sync=False):
         """
@@ -158,34 +817,121 @@ class LibvirtMetadata:
         """
         Load metadata and update the store.
 
-        (Re)Loads global store of metadata.
+        (Re)Loads global store of metadata, loaded metadata are published
+        at once when all domains are loaded.
         """
         with self.libvirt_connection() as conn:
+            with self.__events_lock:
+                self.__pending_reload = False
+            # Domains could be undefined while events were missed
+            self.__device_meta = None
+            domain_uuids = set()
+            domain_names = set()
+            updates = {}
             for domain in conn.listAllDomains():
                 instance = domain.name()
-                self.LIBVIRT_INSTANCES[instance] = self.load_instance_metadata(
-                    domain)
+                domain_names.add(instance)
+                updates[instance] = self.load_instance_metadata(domain)
+                domain_uuids.add(domain.UUIDString())
+            self.update_instances(updates, replace=True)
+            for key in list(self.DOMAIN_DEFINITIONS.keys()):
+                if key not in domain_uuids:
+                    self.DOMAIN_DEFINITIONS.pop(key, None)
+            self.QUARANTINE.prune(domain_names)
+            for instance in list(self.DOMAIN_STATS.keys()):
+                if instance not in domain_names:
+                    self.DOMAIN_STATS.pop(instance, None)
 
     def get_instance_metadata(self, instance, domain=None):
         """Get instance metadata."""
         try:
             if instance is None:
                 return {}
-            if instance in self.LIBVIRT_INSTANCES:
-                return self.LIBVIRT_INSTANCES.get(instance)
+            metadata = self.LIBVIRT_INSTANCES.get(instance)
+            if metadata is not None and time.monotonic() - metadata.loaded < self.INSTANCE_TTL:
+                return metadata
             else:
                 if not domain:
                     with self.libvirt_connection() as conn:
                         domain = conn.lookupByName(instance)
-                return self.load_instance_metadata(domain)
+                metadata = self.load_instance_metadata(domain)
+                if metadata:
+                    self.update_instances({instance: metadata})
+                return metadata
         except Exception:
             return {}
 
+    def domain_fingerprint(self, domain, stats):
+        """
+        Cheap fingerprint of domain definition.
+
+        Changes when domain is restarted or devices are hot(un)plugged.
+
+        :param domain: libvirt domain
+        :param dict stats: statistics data retrieved from libvirt.
+        """
+        return (
+            domain.ID(),
+            stats.get('vcpu.maximum'),
+            stats.get('block.count'),
+            stats.get('net.count'),
+        )
+
+    def get_domain_definition(self, domain, stats=None):
+        """
+        Get cached domain definition.
+
+        Definition is reloaded when invalidated by domain events, when its
+        fingerprint changes (stats needed) or after `DEFINITION_TTL`.
+
+        :param domain: libvirt domain
+        :param dict stats: statistics data retrieved from libvirt (optional)
+
+        :return DomainDefinition: definition (empty if XML is not available)
+        """
+        key = domain.UUIDString()
+        fingerprint = self.domain_fingerprint(domain, stats) if stats else None
+        definition = self.DOMAIN_DEFINITIONS.get(key)
+        if definition is not None and time.monotonic() - definition.loaded < self.DEFINITION_TTL:
+            if definition.fingerprint is None:
+                definition.fingerprint = fingerprint
+            if fingerprint is None or definition.fingerprint == fingerprint:
+                return definition
+        try:
+            definition = self.load_domain_definition(domain.XMLDesc(), fingerprint)
+            self.DOMAIN_DEFINITIONS[key] = definition
+        except Exception:
+            self.instrumentation.error('domain_definition')
+            definition = DomainDefinition(fingerprint)
+        return definition
+
+    def load_domain_definition(self, xml_string, fingerprint=None):
+        """
+        Parse domain XML into domain definition.
+
+        Single pass without building element tree, see `DomainDefinitionParser`.
+
+        :param str xml_string: domain XML description
+        :param fingerprint: fingerprint of the definition (optional)
+
+        :return DomainDefinition: definition
+        """
+        definition = DomainDefinition(fingerprint)
+        parser = ET.XMLParser(target=DomainDefinitionParser(definition))
+        parser.feed(xml_string)
+        return parser.close()
+
     def load_image_metadata(self, metadata, disk):
-        source = disk.find('source')
-        auth = disk.find('auth')
-        driver = disk.find('driver')
-        target = disk.find('target')
+        """
+        Load image metadata of domain disk.
+
+        :param dict metadata: instance metadata
+        :param dict disk: disk of domain definition
+        """
+        source = disk.get('source')
+        auth = disk.get('auth')
+        driver = disk.get('driver')
+        target = disk.get('target')
         pool, volume = ('', '')
         try:
             volume = source.get('name', '')
@@ -206,7 +952,7 @@ class LibvirtMetadata:
             hosts = [
                 '{}:{}'.format(
                     host.get('name', ''), host.get('port', '')
-                ) for host in source.getchildren() if host.get('name') and host.get('port')
+                ) for host in disk.get('hosts', []) if host.get('name') and host.get('port')
             ]
         except Exception:
             hosts = []
@@ -234,12 +980,7 @@ class LibvirtMetadata:
                     metadata = self.load_instance_metadata(domain)
                 except Exception:
                     metadata = {}
-                try:
-                    domain_config = ET.fromstring(domain.XMLDesc())
-                    disks = domain_config.findall('.//disk')
-                except Exception:
-                    disks = []
-                for disk in disks:
+                for disk in self.get_domain_definition(domain).disks:
                     try:
                         image = self.load_image_metadata(metadata, disk)
                         if image['volume'] and image['protocol'] == 'rbd':
@@ -249,70 +990,37 @@ class LibvirtMetadata:
 
         return rbd_images
 
-    def get_cpu_meta(self, domain):
+    def get_cpu_meta(self, domain, stats=None):
         items = {}
-        try:
-            domain_config = ET.fromstring(domain.XMLDesc())
-            f_elems = domain_config.find('.//cpu').findall('.//feature')
-        except Exception:
-            f_elems = []
-        try:
-            model_el = domain_config.find('.//cpu').find('.//model')
-            model = {
-                'fallback': 1 if (model_el.get('fallback') == 'allow') else 0,
-                'name': model_el.text
-            }
-        except Exception:
-            model = {}
         items['variable'] = {}
-        for feature in f_elems:
-            try:
-                required = 1 if (feature.get('policy') == 'require') else 0
-            except Exception:
-                required = 1
-            try:
-                items['variable']['feature:{}'.format(feature.get('name'))] = {
-                    'vm_cpu_feature': required
-                }
-            except Exception:
-                pass
-        if model and model.get('name'):
-            items['variable']['model:{}'.format(model.get('name'))] = {
-                'vm_cpu_model': model.get('fallback')
+        definition = self.get_domain_definition(domain, stats)
+        for name, required in definition.cpu_features:
+            items['variable'][(('feature', str(name)),)] = {
+                'vm_cpu_feature': required
+            }
+        if definition.cpu_model:
+            items['variable'][(('model', definition.cpu_model),)] = {
+                'vm_cpu_model': definition.cpu_fallback
             }
         return items
 
-    def get_gpu_devices(self, domain):
-        gpu_devices = {}
-        try:
-            domain_config = ET.fromstring(domain.XMLDesc())
-            for item in domain_config.findall('.//hostdev'):
-                try:
-                    gpu_info = self._load_xml_tree(item)
-                    alias = gpu_info.get('alias', {}).get('name', 'hostdev')
-                    address = gpu_info.get('source', {}).get('address', {})
-                    gpu_device = dict(
-                        type=gpu_info.get('type'),
-                        alias=alias,
-                        driver=gpu_info.get('driver', {}).get('name', 'unknown'),
-                        pci_domain=address.get('domain', 'unknown'),
-                        bus=address.get('bus', 'unknown'),
-                        slot=address.get('slot', 'unknown'),
-                        function=address.get('function', 'unknown'),
-                    )
-                    key = '{}:{}:{}.{}'.format(
-                        address.get('domain')[2:],
-                        address.get('bus')[2:],
-                        address.get('slot')[2:],
-                        address.get('function')[2:])
-                    gpu_devices[key] = gpu_device
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        return gpu_devices
+    def get_gpu_devices(self, domain, stats=None):
+        return self.get_domain_definition(domain, stats).hostdevs
 
     def get_gpu_device_meta(self):
+        """
+        Get GPU devices of host and their allocation.
+
+        Reloaded after `DEVICE_META_INTERVAL` seconds, on domain events
+        (also undefined domains) and on full metadata reload.
+        """
+        device_meta = self.__device_meta
+        if device_meta is None or time.monotonic() - device_meta[0] >= self.DEVICE_META_INTERVAL:
+            device_meta = self.__device_meta = (time.monotonic(), self.load_gpu_device_meta())
+        # Export pops variable items, cached items are shared
+        return dict(device_meta[1])
+
+    def load_gpu_device_meta(self):
         items = {}
         items['variable'] = {}
 
@@ -320,57 +1028,57 @@ class LibvirtMetadata:
         with self.libvirt_connection() as conn:
             for domain in conn.listAllDomains():
                 gpus_allocated.update(self.get_gpu_devices(domain))
-        pci_devices = get_pci_devices(resolve=False)
+        pci_devices = get_pci_inventory(sysfs_path=self.PCI_DEVICES).devices
 
         for key, device in pci_devices.items():
             try:
                 value = 0 if key in gpus_allocated else 1
                 metrics = ["pci_domain", "bus", "slot", "function", "product_id", "vendor_id", "vendor", "model", "vram_gb"]
-                meta = ','.join(['{}={}'.format(key, value) for key, value in device.items() if (
-                    value and key in metrics)])
+                meta = tuple((key, str(value)) for key, value in device.items() if (
+                    value and key in metrics))
                 if meta not in items['variable']:
                     items['variable'][meta] = dict(gpu_device=value)
                 else:
                     items['variable'][meta].update(gpu_device=value)
             except Exception:
-                pass
+                self.instrumentation.error('gpu_device')
 
         for key, device in pci_devices.items():
             try:
                 value = 0 if key in gpus_allocated else 1
                 allocated = 1 if key in gpus_allocated else 0
                 metrics = ["product_id", "vendor_id", "vendor", "model", "vram_gb"]
-                meta = ','.join(['{}={}'.format(key, value) for key, value in device.items() if (
-                    value and key in metrics)])
+                meta = tuple((key, str(value)) for key, value in device.items() if (
+                    value and key in metrics))
                 if meta not in items['variable']:
                     items['variable'][meta] = dict(gpus_free_total=value, gpus_used_total=allocated)
                 else:
                     items['variable'][meta]['gpus_free_total'] += value
                     items['variable'][meta]['gpus_used_total'] += allocated
             except Exception:
-                pass
+                self.instrumentation.error('gpu_device')
 
         return items
 
-    def get_gpu_meta(self, domain):
+    def get_gpu_meta(self, domain, stats=None):
         items = {}
         items['variable'] = {}
 
-        gpu_devices = self.get_gpu_devices(domain)
-        pci_devices = get_pci_devices(resolve=False)
+        gpu_devices = self.get_gpu_devices(domain, stats)
+        pci_devices = get_pci_inventory(sysfs_path=self.PCI_DEVICES).devices
         metrics = ["pci_domain", "bus", "slot", "function", "product_id", "vendor_id", "vendor", "model", "vram_gb"]
 
         for key, gpu_info in gpu_devices.items():
             try:
-                meta_values = ['{}={}'.format(k, value) for k, value in gpu_info.items() if (
+                meta_values = [(k, str(value)) for k, value in gpu_info.items() if (
                     value and key in metrics)]
 
                 if pci_devices.get(key):
                     device = pci_devices.get(key, {})
                     for index in ["product_id", "vendor_id", "vendor", "model", "vram_gb"]:
-                        meta_values.append('{}={}'.format(index, device.get(index, 'unknown')))
+                        meta_values.append((index, str(device.get(index, 'unknown'))))
 
-                meta = ','.join(meta_values)
+                meta = tuple(meta_values)
                 if meta not in items['variable']:
                     items['variable'][meta] = dict(gpu_allocation=1)
                 elif 'gpu_allocation' not in items['variable'][meta]:
@@ -379,7 +1087,7 @@ class LibvirtMetadata:
                     # If not unique (e.g. disabled bus/slot/func)
                     items['variable'][meta]['gpu_allocation'] += 1
 
-                gpus_total = ','.join(['{}={}'.format(k, value) for k, value in dict(
+                gpus_total = tuple((k, str(value)) for k, value in dict(
                     # type=gpu_info.get('type'),
                     # driver=gpu_info.get('driver', 'unknown'),
                     product_id=pci_devices.get(key, {}).get('product_id', 'unknown'),
@@ -387,24 +1095,88 @@ class LibvirtMetadata:
                     vendor=pci_devices.get(key, {}).get('vendor', 'unknown'),
                     model=pci_devices.get(key, {}).get('model', 'unknown'),
                     vram_gb=pci_devices.get(key, {}).get('vram_gb', ''),
-                ).items() if value])
+                ).items() if value)
                 if gpus_total not in items['variable']:
                     items['variable'][gpus_total] = {'vm_gpus_total': 0}
                 items['variable'][gpus_total]['vm_gpus_total'] += 1
             except Exception:
-                pass
+                self.instrumentation.error('gpu')
 
         return items
 
+    def _export_metadata(self, instance, metadata=None, domain=None):
+        if instance and not metadata or not isinstance(metadata, Mapping):
+            metadata = self.get_instance_metadata(instance, domain=domain)
+        if instance and 'domain' not in metadata:
+            # Metadata are shared, labels are added to a copy
+            metadata = dict(metadata, domain=instance)
+        return metadata
+
+    def label_set(self, instance, metadata, sub_labels=()):
+        """
+        Get sorted label names and values of instance series.
+
+        Label sets are computed once per metadata change of the instance
+        and shared by reference as tuples by all its series.
+
+        :param str instance: instance (domain name), None is not cached
+        :param dict metadata: instance metadata
+        :param tuple sub_labels: additional labels as ((name, value), ...),
+                                 None for all instance labels of info metric
+
+        :return tuple: (label names, label values)
+        """
+        entry = self.LABEL_SETS.get(instance) if instance else None
+        if entry is None or entry[0] is not metadata or entry[1] != self.INFO_METRIC:
+            entry = (metadata, self.INFO_METRIC, {})
+            if instance:
+                self.LABEL_SETS[instance] = entry
+        labels = entry[2].get(sub_labels)
+        if labels is None:
+            labels = dict(sub_labels or ())
+            if sub_labels is not None and self.INFO_METRIC and metadata.get('uuid'):
+                labels['uuid'] = metadata['uuid']
+            else:
+                labels.update(metadata)
+            names = tuple(sorted(labels.keys()))
+            labels = (tuple(sys.intern(x) for x in names), tuple(labels[x] for x in names))
+            entry[2][sub_labels] = labels
+        return labels
+
+    def _parse_sub_labels(self, metaname):
+        """Parse sub-labels encoded in string, e.g. 'vcpu:3' or 'bus=0x3b,slot=0x00'."""
+        splitter = ':' if ':' in metaname else '='
+        return tuple((*x.split(splitter),) for x in metaname.split(','))
+
+    def export_info(self, instance, metadata=None, domain=None, prefix='libv_'):
+        """
+        Export info metric of instance.
+
+        With `INFO_METRIC` enabled a single `domain_info` series per instance
+        carries all instance labels, other series are labeled by uuid only.
+        """
+        if not self.INFO_METRIC:
+            return []
+        metadata = self._export_metadata(instance, metadata, domain)
+        if not metadata.get('uuid'):
+            return []
+        var_keys, var_items = self.label_set(instance, metadata, None)
+        return [['{}domain_info'.format(prefix), var_keys, var_items, 1]]
+
     def export(self, stats_items, instance, metadata=None, domain=None, prefix='libv_'):
+        """
+        Export stats items with instance labels.
+
+        Sub-labels of variable items are given as tuples of (name, value)
+        pairs, strings like 'vcpu:3' are still parsed.
+
+        :return list: [name, label names, label values, value]
+        """
         stats = []
         if not stats_items or not isinstance(stats_items, dict):
             return stats
 
-        if instance and not metadata or not isinstance(metadata, dict):
-            metadata = self.get_instance_metadata(instance, domain=domain)
-        if instance and 'domain' not in metadata:
-            metadata['domain'] = instance
+        metadata = self._export_metadata(instance, metadata, domain)
         if not isinstance(prefix, str):
             prefix = ''
 
@@ -412,14 +1184,10 @@ class LibvirtMetadata:
         if 'variable' in stats_items:
             var_data = stats_items.pop('variable')
             try:
-                for metaname, data in var_data.items():
-                    splitter = ':' if ':' in metaname else '='
-                    submeta = dict([(*x.split(splitter),)
-                                    for x in metaname.split(',')])
-                    for key, value in metadata.items():
-                        submeta[key] = value
-                    var_keys = sorted(submeta.keys())
-                    var_items = [submeta[x] for x in var_keys]
+                for sub_labels, data in var_data.items():
+                    if isinstance(sub_labels, str):
+                        sub_labels = self._parse_sub_labels(sub_labels)
+                    var_keys, var_items = self.label_set(instance, metadata, sub_labels)
                     for item, value in data.items():
                         # Formatting stats
                         stats.append(['{}{}'.format(prefix, item),
@@ -428,8 +1196,7 @@ class LibvirtMetadata:
                 pass
 
         # Formatting stats
-        var_keys = sorted(metadata.keys())
-        var_items = [metadata[x] for x in var_keys]
+        var_keys, var_items = self.label_set(instance, metadata)
         for item, value in stats_items.items():
             stats.append(['{}{}'.format(prefix, item),
                           var_keys, var_items, value])
@@ -441,10 +1208,9 @@ class LibvirtMetadata:
         if not stats_items or not isinstance(stats_items, dict):
             return stats
 
-        if instance and not metadata or not isinstance(metadata, dict):
-            metadata = self.get_instance_metadata(instance, domain=domain)
-        if instance and 'domain' not in metadata:
-            metadata['domain'] = instance
+        metadata = self._export_metadata(instance, metadata, domain)
+        if self.INFO_METRIC and metadata.get('uuid'):
+            metadata = {'uuid': metadata['uuid']}
         if not isinstance(prefix, str):
             prefix = ''
         metadata = ['{}="{}"'.format(key, metadata[key])
@@ -455,7 +1221,9 @@ class LibvirtMetadata:
             var_data = stats_items.pop('variable')
             try:
                 for metaname, data in var_data.items():
-                    if ':' in metaname:
+                    if not isinstance(metaname, str):
+                        metaitems = ['{}="{}"'.format(*mn) for mn in metaname]
+                    elif ':' in metaname:
                         metanames = metaname.split(',')
                         metaitems = ['{}="{}"'.format(
                             *mn.split(':')) for mn in metanames]
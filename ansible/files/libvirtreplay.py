@@ -0,0 +1,369 @@
+"""
+Libvirt replay
+==============
+
+Record libvirt calls of the exporter and replay them without hypervisor.
+
+Capture records every libvirt call made through instrumented connection
+(arguments, result or error and latency), libvirt constants and PCI devices
+from sysfs into a gzip compressed JSON file. Identical results are stored
+once.
+
+.. code-block:: python
+
+    from libvirtreplay import Recorder
+
+    recorder = Recorder()
+    libv_meta.instrumentation.recorder = recorder
+    prom_stats(libv_meta, cc)
+    recorder.save('capture.json.gz', pci_path=libv_meta.PCI_DEVICES)
+
+Replay module stands in for the `libvirt` module, calls are answered from
+the capture at full speed or at recorded timing. Responses of the same call
+are replayed in recorded order and repeat when exhausted.
+
+.. code-block:: python
+
+    import libvirtreplay
+
+    replay = libvirtreplay.load('capture.json.gz', realtime=False)
+    libvirtreplay.install(libvirtmetadata, libvirtconnection, instrumentation)
+    libv_meta = LibvirtMetadata()
+    libv_meta.PCI_DEVICES = replay.create_pci_tree('/tmp/replay')
+
+"""
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+
+VERSION = 1
+PROC_PCI_DEVICES = '/proc/bus/pci/devices'
+_REPLAY = None
+
+
+def encode(value):
+    """Encode libvirt call argument or result as JSON value."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(key), encode(item)) for key, item in value.items())
+    if hasattr(value, 'UUIDString'):
+        return {'$dom': value.UUIDString()}
+    if callable(value):
+        return {'$callable': getattr(value, '__name__', '')}
+    return str(value)
+
+
+def object_key(obj):
+    """Domain UUID or 'conn' for connection."""
+    return obj.UUIDString() if hasattr(obj, 'UUIDString') else 'conn'
+
+
+def call_key(obj, method, args, kwargs):
+    return json.dumps([obj, method, encode(args), encode(kwargs)], sort_keys=True, separators=(',', ':'))
+
+
+def read_pci_devices(path):
+    """
+    Read PCI devices from sysfs.
+
+    :return dict: device name -> attributes and driver
+    """
+    devices = {}
+    for name in sorted(os.listdir(path)):
+        device = {}
+        for attr in ['vendor', 'device', 'class']:
+            try:
+                with open(os.path.join(path, name, attr)) as f:
+                    device[attr] = f.read().strip()
+            except OSError:
+                pass
+        try:
+            device['driver'] = os.path.basename(os.readlink(os.path.join(path, name, 'driver')))
+        except OSError:
+            device['driver'] = ''
+        devices[name] = device
+    return devices
+
+
+class Recorder:
+    """
+    Recorder of libvirt calls.
+
+    Set as `recorder` of `Instrumentation`, instrumented proxies pass every
+    call to `record`.
+    """
+
+    def __init__(self):
+        self.calls = []  # [call key, value index, error, seconds]
+        self.values = []
+        self.__value_index = {}
+        self.__lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, obj, method, args, kwargs, result=None, error=None, seconds=0.0):
+        """
+        Record a libvirt call.
+
+        :param obj: libvirt connection or domain (unwrapped)
+        :param str method: called method
+        :param error: raised exception
+        """
+        try:
+            key = call_key(object_key(obj), method, args, kwargs)
+            value = json.dumps(encode(result), sort_keys=True, separators=(',', ':'))
+            if error is not None:
+                error = [error.get_error_code() if hasattr(error, 'get_error_code') else -1, str(error)]
+        except Exception:
+            return
+        with self.__lock:
+            index = self.__value_index.get(value)
+            if index is None:
+                index = self.__value_index[value] = len(self.values)
+                self.values.append(value)
+            self.calls.append([key, index, error, round(seconds, 6)])
+
+    def save(self, path, pci_path=None, cycles=0):
+        """
+        Write capture to gzip compressed JSON file.
+
+        :param str path: capture file
+        :param str pci_path: sysfs PCI devices to include
+        :param int cycles: number of captured collection cycles
+        """
+        try:
+            import libvirt
+            constants = dict((key, value) for key, value in vars(libvirt).items() if (
+                key.startswith('VIR_') and isinstance(value, int)))
+        except Exception:
+            constants = {}
+        pci = {'devices': {}, 'proc': ''}
+        if pci_path:
+            try:
+                pci['devices'] = read_pci_devices(pci_path)
+            except OSError:
+                pass
+        try:
+            with open(PROC_PCI_DEVICES) as f:
+                pci['proc'] = f.read()
+        except OSError:
+            pass
+        with self.__lock:
+            capture = {
+                'version': VERSION,
+                'created': self.started,
+                'cycles': cycles,
+                'constants': constants,
+                'values': [json.loads(value) for value in self.values],
+                'calls': list(self.calls),
+                'pci': pci,
+            }
+        with gzip.open(path, 'wt', compresslevel=9) as f:
+            json.dump(capture, f, separators=(',', ':'))
+
+
+class libvirtError(Exception):
+    """Replayed libvirt error."""
+
+    def __init__(self, defmsg, error_code=-1):
+        Exception.__init__(self, defmsg)
+        self.error_code = error_code
+
+    def get_error_code(self):
+        return self.error_code
+
+
+class Replay:
+    """Calls loaded from capture file."""
+
+    def __init__(self, capture, realtime=False):
+        self.realtime = realtime
+        self.constants = capture.get('constants', {})
+        self.pci = capture.get('pci', {})
+        self.cycles = capture.get('cycles', 0)
+        values = capture.get('values', [])
+        self.responses = {}  # call key -> [(value, error, seconds)]
+        for key, index, error, seconds in capture.get('calls', []):
+            self.responses.setdefault(key, []).append((values[index], error, seconds))
+        self.domains = {}
+        self.__position = {}
+        self.__lock = threading.Lock()
+
+    def domain(self, uuid):
+        with self.__lock:
+            domain = self.domains.get(uuid)
+            if domain is None:
+                domain = self.domains[uuid] = ReplayDomain(uuid)
+        return domain
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        if isinstance(value, dict):
+            if '$dom' in value:
+                return self.domain(value['$dom'])
+            if '$bytes' in value:
+                return bytes.fromhex(value['$bytes'])
+            return dict((key, self.decode(item)) for key, item in value.items())
+        return value
+
+    def call(self, obj, method, args, kwargs):
+        """Replay next recorded response of the call."""
+        key = call_key(obj, method, args, kwargs)
+        responses = self.responses.get(key)
+        if not responses:
+            raise libvirtError('Call not recorded: {}.{}'.format(obj, method))
+        with self.__lock:
+            position = self.__position.get(key, 0)
+            self.__position[key] = position + 1
+        value, error, seconds = responses[position % len(responses)]
+        if self.realtime and seconds:
+            time.sleep(seconds)
+        if error is not None:
+            raise libvirtError(error[1], error[0])
+        return self.decode(value)
+
+    def create_pci_tree(self, root):
+        """
+        Create captured sysfs PCI devices under `root`.
+
+        :return str: path of sysfs PCI devices
+        """
+        sysfs = os.path.join(root, 'sys', 'bus', 'pci', 'devices')
+        drivers = os.path.join(root, 'sys', 'bus', 'pci', 'drivers')
+        os.makedirs(sysfs, exist_ok=True)
+        for name, device in self.pci.get('devices', {}).items():
+            path = os.path.join(sysfs, name)
+            os.makedirs(path, exist_ok=True)
+            for attr in ['vendor', 'device', 'class']:
+                if attr in device:
+                    with open(os.path.join(path, attr), 'w') as f:
+                        f.write(device[attr] + '\n')
+            link = os.path.join(path, 'driver')
+            if device.get('driver') and not os.path.lexists(link):
+                os.makedirs(os.path.join(drivers, device['driver']), exist_ok=True)
+                os.symlink(os.path.relpath(os.path.join(drivers, device['driver']), path), link)
+        if self.pci.get('proc'):
+            proc = os.path.join(root, 'proc', 'bus', 'pci')
+            os.makedirs(proc, exist_ok=True)
+            with open(os.path.join(proc, 'devices'), 'w') as f:
+                f.write(self.pci['proc'])
+        return sysfs
+
+
+class ReplayObject:
+    """Replayed libvirt connection or domain."""
+
+    def __init__(self, key):
+        self._key = key
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return _REPLAY.call(self._key, name, args, kwargs)
+
+        call.__name__ = name
+        return call
+
+
+class ReplayDomain(ReplayObject):
+    """Replayed libvirt domain."""
+
+    def UUIDString(self):
+        return self._key
+
+
+class virConnect(ReplayObject):
+    """Replayed libvirt connection, connection management is local."""
+
+    def __init__(self):
+        ReplayObject.__init__(self, 'conn')
+        self.alive = True
+
+    def isAlive(self):
+        return 1 if self.alive else 0
+
+    def close(self):
+        self.alive = False
+        return 0
+
+    def setKeepAlive(self, interval, count):
+        return 0
+
+    def registerCloseCallback(self, cb, opaque):
+        return 0
+
+    def unregisterCloseCallback(self):
+        return 0
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        return eventID
+
+    def domainEventDeregisterAny(self, callbackID):
+        return 0
+
+
+virDomain = ReplayDomain
+
+
+def openReadOnly(name=None):
+    if _REPLAY is None:
+        raise libvirtError('No capture loaded')
+    return virConnect()
+
+
+def virEventRegisterDefaultImpl():
+    return 0
+
+
+def virEventRunDefaultImpl():
+    time.sleep(1)
+    return 0
+
+
+def __getattr__(name):
+    """Constants of libvirt recorded in the capture."""
+    if _REPLAY is not None and name in _REPLAY.constants:
+        return _REPLAY.constants[name]
+    raise AttributeError(name)
+
+
+def load(path, realtime=False):
+    """
+    Load capture file for replay.
+
+    :param str path: capture file
+    :param bool realtime: sleep recorded latency of every call
+
+    :return Replay: loaded capture
+    """
+    global _REPLAY
+    with gzip.open(path, 'rt') as f:
+        capture = json.load(f)
+    if capture.get('version') != VERSION:
+        raise ValueError('Unsupported capture version: {}'.format(capture.get('version')))
+    _REPLAY = Replay(capture, realtime=realtime)
+    return _REPLAY
+
+
+def install(*modules):
+    """
+    Use this module as `libvirt` in `modules` and in further imports.
+
+    :param modules: already imported modules referring to libvirt
+    """
+    this = sys.modules[__name__]
+    sys.modules['libvirt'] = this
+    for module in modules:
+        module.libvirt = this
+        if hasattr(module, 'LIBVIRT_TYPES'):
+            module.LIBVIRT_TYPES = (virConnect, ReplayDomain)
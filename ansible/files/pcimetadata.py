@@ -18,8 +18,12 @@
 # } 1.0
 
 import os
-import glob
 import json
+import mmap
+import struct
+import tempfile
+import threading
+import time
 
 
 DRIVERS = ['vfio-pci']
@@ -36,6 +40,16 @@ except Exception:
     }
     MODELS = {}
 
+SYSFS_PCI_DEVICES = '/sys/bus/pci/devices'
+PCI_IDS_PATH = '/usr/share/misc/pci.ids'
+PCI_IDS_INDEX_PATH = '/var/cache/libvirt_exporter/pci.ids.idx'
+# Seconds between checks of PCI device list for changes
+INVENTORY_CHECK_INTERVAL = 5
+_INVENTORIES = {}
+_INVENTORY_LOCK = threading.Lock()
+_PCI_IDS_INDEX = None
+_PCI_IDS_INDEX_LOCK = threading.Lock()
+
 
 def get_pci_dev_slot(dev_fn):
     slot_dev = (((dev_fn) >> 3) & 0x1f)
@@ -46,7 +60,7 @@ def get_pci_func(dev_fn):
     return hex((dev_fn) & 0x07)
 
 
-def get_pci_ids(path='/usr/share/misc/pci.ids'):
+def get_pci_ids(path=PCI_IDS_PATH):
     """
     Get PCI IDs from /usr/share/misc/pci.ids
 
@@ -82,67 +96,262 @@ def get_pci_ids(path='/usr/share/misc/pci.ids'):
     return pci_ids
 
 
-def list_pci_domains(slot):
+class PciIdsIndex:
+    """
+    Compiled pci.ids index
+
+    Binary file with sorted fixed-size records (vendor id, device id, name
+    offset and length) followed by names. File is memory-mapped and searched
+    with binary search, the database is never loaded as a whole.
+
+    Vendor records use device id of 4 spaces which sorts before device records.
+    """
+
+    MAGIC = b'PCIIDX1\n'
+    HEADER = struct.Struct('<8sqqI')  # magic, pci.ids mtime (ns), pci.ids size, records
+    RECORD = struct.Struct('<4s4sIH')  # vendor id, device id, name offset, name length
+    VENDOR = b'    '
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.mtime, self.size, self.count = self.HEADER.unpack_from(self.__mmap, 0)
+        if magic != self.MAGIC:
+            raise ValueError('Invalid pci.ids index: {}'.format(index_path))
+        self.__names = self.HEADER.size + self.count * self.RECORD.size
+
+    @classmethod
+    def build(cls, path=PCI_IDS_PATH, index_path=PCI_IDS_INDEX_PATH):
+        """
+        Compile pci.ids into index file.
+
+        Index is written to a temporary file and moved in place.
+
+        :param str path: pci.ids database
+        :param str index_path: index file
+        """
+        stat = os.stat(path)
+        entries = {}
+        vendor_id = None
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.strip() or line.startswith(b'#') or line.startswith(b'\t\t'):
+                    continue
+                if line.startswith(b'C '):
+                    break  # device classes follow the vendors
+                key, _, name = line.strip().partition(b'  ')
+                if line.startswith(b'\t'):
+                    if vendor_id:
+                        entries.setdefault((vendor_id, key.lower()), name.strip())
+                elif len(key) == 4:
+                    vendor_id = key.lower()
+                    entries.setdefault((vendor_id, cls.VENDOR), name.strip())
+                else:
+                    vendor_id = None
+
+        records = []
+        names = []
+        offset = 0
+        for (vendor, device), name in sorted(entries.items()):
+            records.append(cls.RECORD.pack(vendor, device.ljust(4)[:4], offset, len(name)))
+            names.append(name)
+            offset += len(name)
+
+        directory = os.path.dirname(index_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pci.ids.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, stat.st_mtime_ns, stat.st_size, len(records)))
+                f.write(b''.join(records))
+                f.write(b''.join(names))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, index_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def is_current(self, path=PCI_IDS_PATH):
+        """Check the index was built from current pci.ids."""
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size) == (self.mtime, self.size)
+
+    def lookup(self, vendor_id, product_id=None):
+        """
+        Find vendor or device name.
+
+        :param str vendor_id: vendor id, e.g. "10de"
+        :param str product_id: device id, e.g. "1df6" (default: vendor name)
+
+        :return str: name or None if not found
+        """
+        key = (
+            vendor_id.lower().encode(),
+            product_id.lower().encode() if product_id else self.VENDOR,
+        )
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            vendor, device, offset, length = self.RECORD.unpack_from(
+                self.__mmap, self.HEADER.size + middle * self.RECORD.size)
+            if (vendor, device) < key:
+                low = middle + 1
+            elif (vendor, device) > key:
+                high = middle
+            else:
+                start = self.__names + offset
+                return self.__mmap[start:start + length].decode('utf-8', 'replace')
+        return None
+
+    def vendor(self, vendor_id):
+        return self.lookup(vendor_id)
+
+    def device(self, vendor_id, product_id):
+        return self.lookup(vendor_id, product_id)
+
+
+def get_pci_ids_index(path=PCI_IDS_PATH, index_path=PCI_IDS_INDEX_PATH):
+    """
+    Get compiled pci.ids index.
+
+    Index is built once and rebuilt when pci.ids changes (mtime or size).
+    Falls back to temporary directory when index path is not writable.
+
+    :return PciIdsIndex: index
+    """
+    global _PCI_IDS_INDEX
+    index = _PCI_IDS_INDEX
+    if index is not None and index.is_current(path):
+        return index
+    with _PCI_IDS_INDEX_LOCK:
+        for candidate in [index_path, os.path.join(tempfile.gettempdir(), os.path.basename(index_path))]:
+            try:
+                index = PciIdsIndex(candidate)
+                if index.is_current(path):
+                    break
+            except (OSError, ValueError, struct.error):
+                pass
+            try:
+                PciIdsIndex.build(path, candidate)
+                index = PciIdsIndex(candidate)
+                break
+            except OSError:
+                index = None
+        if index is None:
+            raise OSError('Cannot build pci.ids index from {}'.format(path))
+        _PCI_IDS_INDEX = index
+    return index
+
+
+def _read_sysfs_attr(device_path, attr):
+    with open(os.path.join(device_path, attr)) as f:
+        return f.read().strip()
+
+
+def scan_pci_devices(path=SYSFS_PCI_DEVICES):
+    """
+    Scan PCI devices in sysfs.
+
+    Walks sysfs once, vendor, device and bound driver are read from
+    attributes of each device.
+
+    :return dict: domain:bus:dev.fn -> dict(vendor_id, product_id, driver)
+    """
+    devices = {}
+    for name in sorted(os.listdir(path)):
+        device_path = os.path.join(path, name)
+        try:
+            vendor_id = _read_sysfs_attr(device_path, 'vendor')[2:]
+            product_id = _read_sysfs_attr(device_path, 'device')[2:]
+        except (OSError, IndexError):
+            continue
+        try:
+            driver = os.path.basename(os.readlink(os.path.join(device_path, 'driver')))
+        except OSError:
+            driver = ''
+        devices[name] = dict(vendor_id=vendor_id, product_id=product_id, driver=driver)
+    return devices
+
+
+def index_pci_domains(devices):
+    """
+    Index PCI domains by bus:dev.fn.
+
+    :param dict devices: scanned devices (see `scan_pci_devices`)
+
+    :return dict: bus:dev.fn -> [domains]
+    """
+    index = {}
+    for key in devices:
+        pci_domain, short_slot = key.split(':', 1)
+        index.setdefault(short_slot, []).append(pci_domain)
+    return index
+
+
+def list_pci_domains(slot, *, sysfs_path=SYSFS_PCI_DEVICES):
     """Return ALL domains matching this bus:dev.fn (handles duplicate bus:dev.fn across domains)."""
-    pattern = f'/sys/bus/pci/devices/*:{slot}'
-    return [
-        os.path.basename(m).split(':')[0]
-        for m in glob.glob(pattern)
-    ]
+    return get_pci_inventory(sysfs_path=sysfs_path).domains.get(slot, [])
 
 
-def get_pci_devices(path="/proc/bus/pci/devices", resolve=False, raw=False, by_vendor=False):
+def get_pci_devices(*, sysfs_path=SYSFS_PCI_DEVICES, resolve=False, raw=False, by_vendor=False):
     """
     Get PCI devices
     https://docs.python.org/3/library/string.html#format-specification-mini-language
 
     Using lspci format: `domain:bus:deviceslot.function`
 
+    Devices are read from sysfs in a single pass (see `scan_pci_devices`).
+
+    """
+    return load_pci_devices(scan_pci_devices(sysfs_path), resolve=resolve, raw=raw, by_vendor=by_vendor)
+
+
+def load_pci_devices(scanned, resolve=False, raw=False, by_vendor=False):
+    """
+    Load PCI devices from a sysfs scan.
+
+    :param dict scanned: scanned devices (see `scan_pci_devices`)
+
+    :return dict: domain:bus:dev.fn -> device
     """
     if resolve:
-        pciids = get_pci_ids()
-    items = [x.replace(' ', '').split('\t') for x in open(path).read().split('\n')]
+        pciids = get_pci_ids_index()
     pci_devices = {}
-    pci_domains = {}
-    for item in items:
-        if len(item) > 1 and (item[-1] in DRIVERS or (by_vendor and item[1] and item[1][:4] in VENDORS)):
-            vendor_id = item[1][:4]
-            product_id = item[1][4:]
-            bus_number = item[0][:2]
-            slot_number = get_pci_dev_slot(int(item[0][2:], 16))
-            fn_number = get_pci_func(int(item[0][2:], 16))
+    for slot_key, item in scanned.items():
+        vendor_id = item['vendor_id']
+        product_id = item['product_id']
+        if item['driver'] in DRIVERS or (by_vendor and vendor_id in VENDORS):
+            pci_domain, bus_number, dev_fn = slot_key.split(':')
+            slot_number, fn_number = dev_fn.split('.')
+            dev_fn = (int(slot_number, 16) << 3) | int(fn_number, 16)
             device = dict(
                 bus=format(int(bus_number, 16), '#04x'),  # needs to work for '0a' -> '0x0a'
-                slot=slot_number,
-                function=fn_number,
-                vendor=VENDORS[item[1][:4]],
+                slot=get_pci_dev_slot(dev_fn),
+                function=get_pci_func(dev_fn),
+                vendor=VENDORS.get(vendor_id, 'unknown'),
                 vendor_id=format(int(vendor_id, 16), '#06x'),
                 product_id=format(int(product_id, 16), '#06x'),
-                # irq=item[2],
-                driver=item[-1],
+                driver=item['driver'],
             )
             if resolve:
-                if product_id in pciids[vendor_id]["devices"]:
-                    product = pciids[vendor_id]["devices"][product_id]["name"]
+                vendor = pciids.vendor(vendor_id) or device['vendor']
+                product = pciids.device(vendor_id, product_id)
+                if product:
                     device_name = product.split('[', 1)[0].strip() if '[' in product else product
                     device.update(
-                        vendor=pciids[vendor_id]["name"],
+                        vendor=vendor,
                         model=device_name,
                         product=product,
                     )
                 else:
                     # Device not found in /usr/share/misc/pci.ids
                     device.update(
-                        vendor=pciids[vendor_id]["name"],
+                        vendor=vendor,
                         model=None,
                         product=None,
                     )
             if raw:
-                device.update(raw=item)
-            short_slot = '{}:{}.{}'.format(
-                device.get('bus')[2:],
-                device.get('slot')[2:],
-                device.get('function')[2:])
+                device.update(raw=[slot_key, vendor_id + product_id, item['driver']])
 
             try:
                 if MODELS:
@@ -154,28 +363,74 @@ def get_pci_devices(path="/proc/bus/pci/devices", resolve=False, raw=False, by_v
             except Exception:
                 pass
 
-            # Fetch domains based on bus
-            tmp_domains = list_pci_domains(short_slot)
-            if os.getenv("DEBUG"):
-                print(f"# Domains: {','.join(tmp_domains)}")
-            # link one domain per device if bus:dev.fn is not unique
-            pci_domains.setdefault(short_slot, set())
-            for pci_domain in tmp_domains:
-                if pci_domain not in pci_domains[short_slot]:
-                    pci_domains[short_slot].add(pci_domain)
-                    slot_key = f"{pci_domain}:{short_slot}"
-                    device.update(pci_domain=f"0x{pci_domain}")
-                    break
-            else:
-                # In case domain is not matched a default domain 0 is used.
-                slot_key = f"0000:{short_slot}"
-
+            device.update(pci_domain=f"0x{pci_domain}")
             if os.getenv("DEBUG"):
                 print(f"# Device: {slot_key}")
             pci_devices[slot_key] = device
     return pci_devices
 
 
+class PciInventory:
+    """
+    PCI inventory
+
+    Devices returned by `get_pci_devices` indexed by slot (domain:bus:dev.fn)
+    and PCI domains of all scanned devices (see `index_pci_domains`).
+    Inventory is rebuilt only when fingerprint of the device list changes.
+    """
+
+    def __init__(self, fingerprint, devices, domains):
+        self.fingerprint = fingerprint
+        self.checked = time.monotonic()
+        self.devices = devices  # domain:bus:dev.fn -> device
+        self.domains = domains  # bus:dev.fn -> [domains]
+
+
+def get_pci_fingerprint(*, sysfs_path=SYSFS_PCI_DEVICES):
+    """
+    Get fingerprint of PCI device list.
+
+    Fingerprint changes with added or removed devices and with driver
+    bindings (e.g. vfio-pci).
+    """
+    fingerprint = []
+    for name in sorted(os.listdir(sysfs_path)):
+        try:
+            driver = os.readlink(os.path.join(sysfs_path, name, 'driver'))
+        except OSError:
+            driver = ''
+        fingerprint.append((name, driver))
+    return tuple(fingerprint)
+
+
+def get_pci_inventory(*, sysfs_path=SYSFS_PCI_DEVICES, resolve=False, raw=False, by_vendor=False):
+    """
+    Get cached PCI inventory.
+
+    Device list is checked for changes at most every `INVENTORY_CHECK_INTERVAL`
+    seconds, devices are loaded again only if the fingerprint changed.
+
+    :return PciInventory: inventory of devices
+    """
+    key = (sysfs_path, resolve, raw, by_vendor)
+    inventory = _INVENTORIES.get(key)
+    if inventory and time.monotonic() - inventory.checked < INVENTORY_CHECK_INTERVAL:
+        return inventory
+    with _INVENTORY_LOCK:
+        inventory = _INVENTORIES.get(key)
+        if inventory and time.monotonic() - inventory.checked < INVENTORY_CHECK_INTERVAL:
+            return inventory
+        fingerprint = get_pci_fingerprint(sysfs_path=sysfs_path)
+        if inventory and inventory.fingerprint == fingerprint:
+            inventory.checked = time.monotonic()
+        else:
+            scanned = scan_pci_devices(sysfs_path)
+            inventory = PciInventory(fingerprint, load_pci_devices(
+                scanned, resolve=resolve, raw=raw, by_vendor=by_vendor), index_pci_domains(scanned))
+            _INVENTORIES[key] = inventory
+    return inventory
+
+
 if __name__ == "__main__":
     devices = get_pci_devices(resolve=True, by_vendor=True)
     items = []
@@ -18,18 +18,92 @@ function `basic_fn`.
     scheduler.run_concurrent()
 
 Heartbeat print is run every 2 seconds.
+
+Triggered task runs whenever its trigger is called, from any thread, e.g.
+on events instead of polling:
+
+.. sourcecode:: python
+
+    trigger = scheduler.add_triggered_task(process_events)
+    events.on_event.append(trigger)
+
+Periodic task is never run concurrently with itself. When the previous run
+is still in progress the `overlap` policy of the task decides:
+
+* ``skip`` - drop the run,
+* ``coalesce`` - merge all runs missed meanwhile into a single run started
+  right after the previous one finishes.
+
+Tasks run in a thread pool executor, coroutine functions are awaited on
+the loop instead.
+
+Runs, skipped and coalesced runs, lateness and duration are counted per task
+in `Scheduler.task_stats`.
+
+Timers of all tasks are kept in a single heap of monotonic deadlines, the
+scheduler sleeps until the earliest one. Alignment of periods (`unit`,
+`round`, delay) is anchored to wall-clock time once, so stepping the system
+clock does not repeat or skip runs.
 """
 import asyncio
 import concurrent.futures
 import functools
+import heapq
 import signal
 import sys
+import time
 import traceback
 import uuid
 from datetime import datetime
 from datetime import timedelta
 
 
+class TaskStats:
+    """Accounting of a periodic task."""
+
+    __slots__ = ('name', 'overlap', 'running', 'pending', 'runs', 'skipped', 'coalesced', 'lateness', 'duration')
+
+    def __init__(self, name, overlap='skip'):
+        self.name = name
+        self.overlap = overlap
+        self.running = False
+        self.pending = None  # scheduled time of the run waiting for the running one
+        self.runs = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.lateness = 0.0  # seconds between scheduled and actual start of the last run
+        self.duration = 0.0  # seconds of the last finished run
+
+
+class Timer:
+    """
+    Timer of a scheduled task.
+
+    Holds wall-clock time the task is aligned to (`next_run`) and the
+    matching monotonic `deadline`. Timer with `state` is periodic.
+    """
+
+    __slots__ = ('task', 'args', 'unit', 'round', 'delay', 'state', 'next_run', 'deadline')
+
+    def __init__(self, task, args=(), unit='hour', round=1, delay=0, state=None):
+        self.task = task
+        self.args = args
+        self.unit = unit
+        self.round = round
+        self.delay = delay
+        self.state = state
+        self.next_run = None
+        self.deadline = None
+
+    @property
+    def task_id(self):
+        return '{}:{}'.format('period' if self.state else 'delay', self.task.__name__)
+
+    @property
+    def loglevel(self):
+        return 'INFO' if self.unit == 'day' else 'DEBUG'
+
+
 class Scheduler:
     """
     Task scheduler.
@@ -47,7 +121,13 @@ class Scheduler:
         # Pool is used for execution of tasks
         self.__executor = concurrent.futures.ThreadPoolExecutor(
             max_workers=max_workers)
-        self.__tasks = []
+        # Heap of (monotonic deadline, sequence, timer)
+        self.__timers = []
+        self.__sequence = 0
+        self.__running = set()
+        self.__wakeup = None
+        self.__coroutines = []
+        self.task_stats = {}
         self.exception_caught = False
         self.debug = False
 
@@ -61,7 +141,8 @@ class Scheduler:
             self.__handle_exception, self.__executor
         ))
 
-    def add_periodic_task(self, task, unit='hour', run_now=False, periodic_delay=0, round=1, args=()):
+    def add_periodic_task(self, task, unit='hour', run_now=False, periodic_delay=0, round=1, args=(),
+                          overlap='skip', name=None):
         """
         Add periodic task for scheduler.
 
@@ -73,67 +154,65 @@ class Scheduler:
         :param dict periodic_delay: periodic delay is added waiting time to every period
                                     E.g. expect task to run every day, 5h after midnight
                                     periodic_delay={'hours': 5} and unit='day'
+        :param str overlap: policy when previous run is still in progress,
+                            value has to be "skip" or "coalesce" (default: "skip")
+        :param str name: name of the task in `task_stats` (default: task name)
         """
+        if overlap not in ['skip', 'coalesce']:
+            raise ValueError('Unknown overlap policy: {}'.format(overlap))
         self.__process_delay(
             periodic_delay)  # Test passed variable only, lambdas are resolved in each period
-        self.__tasks.append(self.__periodic_callback(
-            self.__executor, task, unit, run_now=run_now, periodic_delay=periodic_delay, round=round, args=args
-        ))
+        state = TaskStats(name or task.__name__, overlap)
+        self.task_stats[state.name] = state
+        timer = Timer(task, args, unit, round, periodic_delay, state=state)
+        self.__schedule(timer, run_now=run_now)
 
-    async def __periodic_callback(self, executor, task, unit, run_now=False, round=1, periodic_delay=0, args=()):
+    def add_triggered_task(self, task, args=(), overlap='coalesce', name=None):
         """
-        Provide periodic callbacks with delay.
+        Add task run when its trigger is called.
 
-        Run in loop to schedule next run of task based on period intervals.
-        When task is scheduled wait for the next period to schedule new run.
+        Trigger is threadsafe and never blocks, task runs in the executor
+        (coroutine function on the loop). Triggers while the task runs are
+        handled by `overlap` policy as for periodic tasks.
 
-        :param task: method that will be run periodically
-        :param bool run_now: run the task without delay (in debug only, default: False)
-                             then run next within 1st period as it would run normally.
-        :param str unit: unit of callback (time between calldelays),
-                         value has to be "second", "minute", "hour", or "day"
-        :param dict periodic_delay: periodic delay is added waiting time to every period
-                                    E.g. expect task to run every day, 5h after midnight
-                                    periodic_delay={'hours': 5} and unit='day'
+        :param task: method run on trigger
+        :param str overlap: policy when previous run is still in progress,
+                            value has to be "skip" or "coalesce" (default: "coalesce")
+        :param str name: name of the task in `task_stats` (default: task name)
+
+        :return: trigger function
         """
-        loop = asyncio.get_event_loop()
-        loglevel = 'INFO' if unit == 'day' else 'DEBUG'
-        async_sleep = self.__async_sleep if unit in [
-            'second', 'minute', 'hour'] else self.__async_hard_sleep
-        # Compute time of next run and optimal delay to sleep
-        next_run, delay = (
-            datetime.now().replace(microsecond=0), 0
-        ) if run_now else self.__get_wait_time(unit, round, periodic_delay)
-        run_now = False  # Hard reset to avoid looping tasks
-
-        while True:
-            # Schedule the task
-            task_id = 'period:{}:{}'.format(task.__name__, uuid.uuid4())
-            self.log('{} - task scheduled at: {}'.format(task_id,
-                                                         next_run), loglevel, source='TASK')
-            loop.call_later(delay, self.__callback, executor,
-                            task, task_id, next_run, args)
-            # Wait the same period before scheduling next run
-            await async_sleep(next_run, delay)
-            next_run, delay = self.__get_wait_time(unit, round, periodic_delay)
+        if overlap not in ['skip', 'coalesce']:
+            raise ValueError('Unknown overlap policy: {}'.format(overlap))
+        state = TaskStats(name or task.__name__, overlap)
+        self.task_stats[state.name] = state
+        timer = Timer(task, args, state=state)
+
+        def fire():
+            timer.next_run = datetime.now()
+            timer.deadline = time.monotonic()
+            self.__fire(timer)
+
+        def trigger():
+            try:
+                self.loop.call_soon_threadsafe(fire)
+            except RuntimeError:
+                pass  # loop closed
 
-    def add_delayed_task(self, task, unit='hour', run_now=False, delay=0, round=1, args=()):
+        return trigger
+
+    def add_coroutine(self, coroutine):
         """
-        Add delayed task.
+        Add coroutine run on the scheduler loop.
 
-        Period should usually start with the beginning of next windows.
-        After the delay task is assigned to executor pool where
-        it is run threadsafe.
+        Coroutine runs beside timers until it returns or scheduler stops,
+        e.g. a server serving on the loop.
 
-        :param int delay: delay in valid timedelta {'hours': 3},
-        :param task: method that will be run periodically
+        :param coroutine: coroutine object
         """
-        delay = self.__process_delay(delay)
-        self.__tasks.append(self.__delayed_callback(
-            self.__executor, task, unit, run_now=run_now, delay=delay, round=round, args=args
-        ))
+        self.__coroutines.append(coroutine)
 
-    async def __delayed_callback(self, executor, task, unit='hour', run_now=False, delay=0, round=1, args=()):
+    def add_delayed_task(self, task, unit='hour', run_now=False, delay=0, round=1, args=()):
         """
         Add delayed task.
 
@@ -141,41 +220,147 @@ class Scheduler:
         After the delay task is assigned to executor pool where
         it is run threadsafe.
 
-        :param task: method that will be run periodically
+        :param task: method that will be run once
         :param str unit: unit of callback (time between calls),
                          value has to be "second", "minute", "hour", or "day"
         :param int delay: delay over unit as timedelta {'hours': 3},
         :param int round: rounding unit windows (default every 1st hour)
         :param bool run_now: run the task without delay (in debug only, default: False)
         """
+        self.__process_delay(delay)  # Test passed variable only
+        self.__schedule(Timer(task, args, unit, round, delay), run_now=run_now)
+
+    def __schedule(self, timer, run_now=False):
+        """
+        Push the first deadline of the timer.
+
+        Wall-clock time aligned to `unit`, `round` and delay is the anchor of
+        the timer, it is converted to monotonic deadline once. Following
+        deadlines are advanced on the monotonic clock only.
+        """
+        now = datetime.now()
+        if run_now:
+            timer.next_run = now.replace(microsecond=0)
+            timer.deadline = time.monotonic()
+        else:
+            timer.next_run = self.round_up_time(
+                now, unit=timer.unit, round=timer.round, delay=self.__process_delay(timer.delay))
+            timer.deadline = time.monotonic() + max((timer.next_run - now).total_seconds(), 0)
+        self.__push(timer)
+
+    def __push(self, timer, wakeup=True):
+        self.log('{} - task scheduled at: {}'.format(
+            timer.task_id, timer.next_run), timer.loglevel, source='TASK')
+        self.__sequence += 1
+        heapq.heappush(self.__timers, (timer.deadline, self.__sequence, timer))
+        if wakeup and self.__wakeup is not None:
+            self.loop.call_soon_threadsafe(self.__wakeup.set)
+
+    def __reschedule(self, timer):
+        """
+        Advance periodic timer to its next period.
+
+        Next period is computed from the previous scheduled time (not the
+        current wall-clock), so stepping the system clock neither repeats
+        nor skips runs. Periods missed while the loop was blocked are
+        counted as skipped.
+        """
+        next_run = self.round_up_time(
+            timer.next_run, unit=timer.unit, round=timer.round, delay=self.__process_delay(timer.delay))
+        timer.deadline += (next_run - timer.next_run).total_seconds()
+        timer.next_run = next_run
+        now = time.monotonic()
+        while timer.deadline <= now:
+            timer.state.skipped += 1
+            next_run = self.round_up_time(
+                timer.next_run, unit=timer.unit, round=timer.round, delay=self.__process_delay(timer.delay))
+            timer.deadline += (next_run - timer.next_run).total_seconds()
+            timer.next_run = next_run
+        self.__push(timer, wakeup=False)
+
+    async def __run_timers(self):
+        """
+        Run timers from the heap.
+
+        Sleeps exactly until the earliest deadline (at most an hour, avoiding
+        limits on asyncio sleep times). Ends when no timer is left.
+        """
+        self.__wakeup = asyncio.Event()
+        while self.__timers or self.__running:
+            now = time.monotonic()
+            while self.__timers and self.__timers[0][0] <= now:
+                _, _, timer = heapq.heappop(self.__timers)
+                self.__fire(timer)
+                if timer.state is not None:
+                    self.__reschedule(timer)
+            if not self.__timers and self.__running:
+                await asyncio.gather(*self.__running, return_exceptions=True)
+                continue
+            self.__wakeup.clear()
+            timeout = min(self.__timers[0][0] - time.monotonic(), 3600) if self.__timers else 3600
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                if timeout >= 3600:
+                    self.log('Heartbeat', 'DEBUG')
+
+    def __fire(self, timer):
+        """Assign task of the timer to executor."""
+        task_id = '{}:{}'.format(timer.task_id, uuid.uuid4())
+        self.log('{} - task started'.format(task_id),
+                 'DEBUG', source='TASK')
+        future = self.loop.create_task(self.__run(timer, timer.deadline))
+        self.__running.add(future)
+        future.add_done_callback(self.__running.discard)
+        future.add_done_callback(functools.partial(
+            self.__handle_task_exception, task_id
+        ))
+
+    async def __run(self, timer, deadline):
+        """
+        Run task, applying overlap policy of periodic task.
+
+        :param Timer timer: timer of the task
+        :param float deadline: monotonic time the run was scheduled at
+        """
         loop = asyncio.get_event_loop()
-        # Compute time of next run and optimal delay to sleep
-        next_run, delay = (datetime.now(), 0) if run_now else self.__get_wait_time(
-            unit, round, delay)
-        task_id = 'delay:{}:{}'.format(task.__name__, uuid.uuid4())
-        self.log('{} - task scheduled at: {}'.format(task_id,
-                                                     next_run), 'DEBUG', source='TASK')
-        loop.call_later(delay, self.__callback, executor,
-                        task, task_id, next_run, args)
-
-    def __callback(self, executor, task, task_id, next_run, args):
-        """Assign task to executor when called."""
-        async def assign_to_executor(executor, task, next_run, args):
-            loop = asyncio.get_event_loop()
-            await self.__async_sleep(next_run, 0)
-            if loop.is_running():
-                await loop.run_in_executor(executor, task, *args)
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            self.log('{} - task started'.format(task_id),
-                     'DEBUG', source='TASK')
-            future = asyncio.run_coroutine_threadsafe(
-                assign_to_executor(executor, task, next_run, args),
-                loop
-            )
-            future.add_done_callback(functools.partial(
-                self.__handle_task_exception, task_id
-            ))
+        state = timer.state
+        if state is None:
+            await self.__call(loop, timer)
+            return
+        if state.running:
+            if state.overlap == 'skip':
+                state.skipped += 1
+                self.log('{} - task skipped, previous run in progress'.format(timer.task_id),
+                         'DEBUG', source='TASK')
+            elif state.pending:
+                state.coalesced += 1
+            else:
+                state.pending = deadline
+            return
+        state.running = True
+        try:
+            while loop.is_running():
+                state.runs += 1
+                start = time.monotonic()
+                state.lateness = max(start - deadline, 0)
+                try:
+                    await self.__call(loop, timer)
+                finally:
+                    state.duration = time.monotonic() - start
+                if not state.pending:
+                    break
+                deadline, state.pending = state.pending, None
+        finally:
+            state.running = False
+            state.pending = None
+
+    async def __call(self, loop, timer):
+        """Await coroutine function on the loop, run other tasks in executor."""
+        if asyncio.iscoroutinefunction(timer.task):
+            await timer.task(*timer.args)
+        else:
+            await loop.run_in_executor(self.__executor, timer.task, *timer.args)
 
     def round_up_time(self, usedate=None, unit='minute', round=1, delay=0):
         """
@@ -196,27 +381,6 @@ class Scheduler:
         delay = delay if delay < delta else 0
         return usedate + timedelta(0, rounding - seconds + delay, -usedate.microsecond)
 
-    async def __async_sleep(self, next_run, delay):
-        """
-        Sleep and assure next run period.
-        """
-        await asyncio.sleep(delay)
-        while datetime.now() <= next_run:
-            # Assure next period window
-            await asyncio.sleep(0.2)
-
-    async def __async_hard_sleep(self, next_run, delay):
-        """
-        Break down long waiting sleep into hours.
-
-        Avoiding limits on asyncio sleeptimes.
-        """
-        while delay > 3600:
-            await asyncio.sleep(3600)
-            delay = delay - 3600
-            self.log('Heartbeat', "DEBUG")
-        await self.__async_sleep(next_run, delay)
-
     def __process_delay(self, delay):
         if delay:
             processed = dict((k, v()) if callable(v) else (k, v)
@@ -224,11 +388,6 @@ class Scheduler:
             return int(timedelta(**processed).total_seconds())
         return delay
 
-    def __get_wait_time(self, unit, round, delay):
-        processed = self.__process_delay(delay)
-        next_run = self.round_up_time(unit=unit, round=round, delay=processed)
-        return (next_run, (next_run - datetime.now()).seconds)
-
     def log(self, message, type='INFO', source='SCHEDULER'):
         """
         Log message to stdout/stderr
@@ -326,7 +485,8 @@ class Scheduler:
         self.debug = debug
         try:
             gathered_tasks = asyncio.gather(
-                *self.__tasks,
+                self.__run_timers(),
+                *self.__coroutines,
                 return_exceptions=handle_exceptions
             )
             try:
@@ -0,0 +1,79 @@
+"""
+Fake host
+=========
+
+Synthetic PCI devices of a hypervisor for benchmarks.
+
+Creates `/proc/bus/pci/devices` and `/sys/bus/pci/devices` tree (vendor,
+device, class attributes and driver links) under a root directory. GPUs are
+bound to vfio-pci, other devices to their usual drivers.
+
+.. code-block:: python
+
+    from fakehost import create_host
+
+    host = create_host('/tmp/fakehost', gpus=8)
+    host['sysfs']  # /tmp/fakehost/sys/bus/pci/devices
+    host['gpus']  # [(domain, bus, slot, function)]
+
+"""
+import os
+
+# vendor, device, class, driver
+GPU = ('10de', '1df6', '030200', 'vfio-pci')
+DEVICES = [
+    ('8086', '2020', '060000', 'pcieport'),
+    ('8086', '37d2', '020000', 'i40e'),
+    ('8086', '2021', '088000', 'ioatdma'),
+    ('15b3', '1017', '020000', 'mlx5_core'),
+    ('1000', '0097', '010700', 'mpt3sas'),
+    ('102b', '0536', '030000', ''),
+]
+
+
+def create_host(root, gpus=8, devices=64):
+    """
+    Create fake PCI devices of a host.
+
+    :param str root: directory of the fake host
+    :param int gpus: number of GPUs bound to vfio-pci
+    :param int devices: number of other PCI devices
+
+    :return dict: paths (proc, sysfs) and PCI addresses of GPUs
+    """
+    sysfs = os.path.join(root, 'sys', 'bus', 'pci', 'devices')
+    drivers = os.path.join(root, 'sys', 'bus', 'pci', 'drivers')
+    proc = os.path.join(root, 'proc', 'bus', 'pci', 'devices')
+    os.makedirs(sysfs, exist_ok=True)
+    os.makedirs(os.path.dirname(proc), exist_ok=True)
+
+    # Other devices on buses 0x00-0x3a, GPUs 4 per bus from 0x3b
+    addresses = []
+    for index in range(min(devices, 0x3b * 32)):
+        addresses.append((0, index // 32, index % 32, 0) + DEVICES[index % len(DEVICES)])
+    gpu_addresses = []
+    for index in range(gpus):
+        address = (0, 0x3b + index // 4, index % 4, 0)
+        gpu_addresses.append(address)
+        addresses.append(address + GPU)
+
+    lines = []
+    for pci_domain, bus, slot, function, vendor, device, pci_class, driver in addresses:
+        name = '{:04x}:{:02x}:{:02x}.{:x}'.format(pci_domain, bus, slot, function)
+        path = os.path.join(sysfs, name)
+        os.makedirs(path, exist_ok=True)
+        for attr, value in [('vendor', vendor), ('device', device), ('class', pci_class)]:
+            with open(os.path.join(path, attr), 'w') as f:
+                f.write('0x{}\n'.format(value))
+        link = os.path.join(path, 'driver')
+        if os.path.lexists(link):
+            os.unlink(link)
+        if driver:
+            os.makedirs(os.path.join(drivers, driver), exist_ok=True)
+            os.symlink(os.path.relpath(os.path.join(drivers, driver), path), link)
+        lines.append('{:02x}{:02x}\t{}{}\t0\t{}'.format(bus, slot << 3 | function, vendor, device, driver))
+
+    with open(proc, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return {'root': root, 'proc': proc, 'sysfs': sysfs, 'gpus': gpu_addresses}
@@ -0,0 +1,305 @@
+"""
+Fake libvirt
+============
+
+In-process stand-in for the `libvirt` module used by benchmarks.
+
+Synthetic hypervisor with N running domains, each with configurable vcpus,
+disks, NICs, PCI hostdevs and nova metadata. Only the API used by the
+exporter is implemented.
+
+.. code-block:: python
+
+    import sys
+    import fakelibvirt
+
+    fakelibvirt.configure(domains=100, vcpus=4, disks=2, nics=2, hostdevs=1)
+    sys.modules['libvirt'] = fakelibvirt
+
+"""
+import time
+import uuid
+
+VIR_CONNECT_LIST_DOMAINS_RUNNING = 16
+VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING = 2
+VIR_CONNECT_GET_ALL_DOMAINS_STATS_NOWAIT = 1 << 29
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_CONTROL_OK = 0
+VIR_DOMAIN_STATS_STATE = 1
+VIR_DOMAIN_STATS_CPU_TOTAL = 2
+VIR_DOMAIN_STATS_BALLOON = 4
+VIR_DOMAIN_STATS_VCPU = 8
+VIR_DOMAIN_STATS_INTERFACE = 16
+VIR_DOMAIN_STATS_BLOCK = 32
+VIR_DOMAIN_METADATA_ELEMENT = 2
+STATS_PREFIXES = [
+    (VIR_DOMAIN_STATS_STATE, 'state.'),
+    (VIR_DOMAIN_STATS_CPU_TOTAL, 'cpu.'),
+    (VIR_DOMAIN_STATS_BALLOON, 'balloon.'),
+    (VIR_DOMAIN_STATS_VCPU, 'vcpu.'),
+    (VIR_DOMAIN_STATS_INTERFACE, 'net.'),
+    (VIR_DOMAIN_STATS_BLOCK, 'block.'),
+]
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED = 15
+VIR_DOMAIN_EVENT_ID_DEVICE_ADDED = 19
+VIR_DOMAIN_EVENT_ID_METADATA_CHANGE = 23
+VIR_DOMAIN_EVENT_DEFINED = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_STOPPED = 5
+VIR_ERR_NO_SUPPORT = 3
+VIR_ERR_INVALID_ARG = 8
+VIR_ERR_NO_DOMAIN = 42
+
+NOVA_NS = 'http://openstack.org/xmlns/libvirt/nova/1.1'
+
+HOST = {
+    'domains': 10,
+    'vcpus': 4,
+    'disks': 2,
+    'nics': 2,
+    'hostdevs': 0,  # hostdevs per domain (from `gpus` of the host)
+    'gpus': [],  # PCI addresses (domain, bus, slot, function) of host GPUs
+    'latency': 0.0,  # seconds added to every remote call
+}
+
+
+def configure(**kwargs):
+    """
+    Configure synthetic hypervisor.
+
+    :param int domains: number of running domains
+    :param int vcpus: vcpus per domain
+    :param int disks: disks per domain
+    :param int nics: NICs per domain
+    :param int hostdevs: PCI hostdevs per domain (while host GPUs last)
+    :param list gpus: PCI addresses of host GPUs
+    :param float latency: seconds added to every remote call
+    """
+    unknown = set(kwargs) - set(HOST)
+    if unknown:
+        raise TypeError('Unknown options: {}'.format(', '.join(sorted(unknown))))
+    HOST.update(kwargs)
+
+
+class libvirtError(Exception):
+    def __init__(self, defmsg, error_code=1):
+        Exception.__init__(self, defmsg)
+        self.error_code = error_code
+
+    def get_error_code(self):
+        return self.error_code
+
+
+def remote_call():
+    if HOST['latency']:
+        time.sleep(HOST['latency'])
+
+
+def nova_metadata(index, namespace=True):
+    """
+    Nova metadata of a domain.
+
+    Metadata element is returned by libvirt without namespace, domain XML
+    contains it with nova namespace.
+    """
+    ports = ''.join(
+        '<nova:port uuid="{}"><nova:ip type="fixed" address="10.{}.{}.{}" ipVersion="4"/></nova:port>'.format(
+            uuid.UUID(int=(index << 8) + nic), nic, index // 250 % 250, index % 250 + 2)
+        for nic in range(HOST['nics']))
+    xml = (
+        '<nova:instance{xmlns}>'
+        '<nova:package version="27.1.0"/>'
+        '<nova:name>vm-{index}</nova:name>'
+        '<nova:creationTime>2024-01-01 00:00:00</nova:creationTime>'
+        '<nova:flavor name="m1.bench">'
+        '<nova:memory>4096</nova:memory><nova:disk>40</nova:disk><nova:swap>0</nova:swap>'
+        '<nova:ephemeral>0</nova:ephemeral><nova:vcpus>{vcpus}</nova:vcpus>'
+        '</nova:flavor>'
+        '<nova:owner>'
+        '<nova:user uuid="{user}">user-{index}</nova:user>'
+        '<nova:project uuid="{project}">project-{project_index}</nova:project>'
+        '</nova:owner>'
+        '<nova:root type="image" uuid="{image}"/>'
+        '<nova:ports>{ports}</nova:ports>'
+        '</nova:instance>'
+    ).format(
+        xmlns=' xmlns:nova="{}"'.format(NOVA_NS) if namespace else '', index=index, vcpus=HOST['vcpus'],
+        user=uuid.UUID(int=index), project=uuid.UUID(int=index % 20), project_index=index % 20,
+        image=uuid.UUID(int=1), ports=ports)
+    return xml if namespace else xml.replace('nova:', '')
+
+
+class virDomain:
+    def __init__(self, conn, index):
+        self._conn = conn
+        self.index = index
+        self.uuid = uuid.UUID(int=(1 << 64) + index)
+        self.gpus = HOST['gpus'][index * HOST['hostdevs']:(index + 1) * HOST['hostdevs']]
+
+    def name(self):
+        return 'instance-{:08x}'.format(self.index)
+
+    def ID(self):
+        return self.index + 1
+
+    def UUID(self):
+        return self.uuid.bytes
+
+    def UUIDString(self):
+        return str(self.uuid)
+
+    def isActive(self):
+        return 1
+
+    def state(self):
+        remote_call()
+        return [VIR_DOMAIN_RUNNING, 1]
+
+    def controlInfo(self):
+        remote_call()
+        return [VIR_DOMAIN_CONTROL_OK, 0, 0]
+
+    def memoryStats(self):
+        remote_call()
+        return {'actual': 4194304, 'available': 4000000, 'unused': 1000000, 'rss': 3000000}
+
+    def metadata(self, type, uri, flags=0):
+        remote_call()
+        return nova_metadata(self.index, namespace=False)
+
+    def XMLDesc(self, flags=0):
+        remote_call()
+        disks = ''.join(
+            '<disk type="network" device="disk">'
+            '<driver name="qemu" type="raw" cache="writeback" discard="unmap"/>'
+            '<auth username="nova"><secret type="ceph" uuid="{secret}"/></auth>'
+            '<source protocol="rbd" name="vms/{uuid}_disk{suffix}">'
+            '<host name="10.0.0.1" port="6789"/><host name="10.0.0.2" port="6789"/>'
+            '<host name="10.0.0.3" port="6789"/></source>'
+            '<target dev="vd{dev}" bus="virtio"/><alias name="virtio-disk{disk}"/>'
+            '</disk>'.format(secret=uuid.UUID(int=7), uuid=self.uuid, suffix='' if disk == 0 else '.{}'.format(disk),
+                             dev=chr(ord('a') + disk), disk=disk)
+            for disk in range(HOST['disks']))
+        nics = ''.join(
+            '<interface type="bridge"><mac address="fa:16:3e:00:{:02x}:{:02x}"/>'
+            '<source bridge="qbr{}"/><target dev="tap{:08x}-{}"/><model type="virtio"/></interface>'.format(
+                self.index % 256, nic, nic, self.index, nic)
+            for nic in range(HOST['nics']))
+        hostdevs = ''.join(
+            '<hostdev mode="subsystem" type="pci" managed="yes"><driver name="vfio"/>'
+            '<source><address domain="0x{:04x}" bus="0x{:02x}" slot="0x{:02x}" function="0x{:x}"/></source>'
+            '<alias name="hostdev{}"/><address type="pci" domain="0x0000" bus="0x00" slot="0x{:02x}" function="0x0"/>'
+            '</hostdev>'.format(*gpu, n, 0x10 + n)
+            for n, gpu in enumerate(self.gpus))
+        return (
+            '<domain type="kvm" id="{id}"><name>{name}</name><uuid>{uuid}</uuid>'
+            '<metadata>{metadata}</metadata>'
+            '<memory unit="KiB">4194304</memory><vcpu placement="static">{vcpus}</vcpu>'
+            '<cpu mode="custom" match="exact" check="full"><model fallback="forbid">Skylake-Server-IBRS</model>'
+            '<topology sockets="{vcpus}" cores="1" threads="1"/>'
+            '<feature policy="require" name="ssbd"/><feature policy="require" name="md-clear"/>'
+            '<feature policy="disable" name="x2apic"/><feature policy="require" name="hypervisor"/></cpu>'
+            '<devices><emulator>/usr/bin/qemu-system-x86_64</emulator>{disks}{nics}{hostdevs}'
+            '<serial type="pty"><target port="0"/></serial><video><model type="cirrus"/></video>'
+            '</devices></domain>'
+        ).format(id=self.ID(), name=self.name(), uuid=self.uuid, metadata=nova_metadata(self.index),
+                 vcpus=HOST['vcpus'], disks=disks, nics=nics, hostdevs=hostdevs)
+
+    def stats(self):
+        stats = {
+            'state.state': VIR_DOMAIN_RUNNING, 'state.reason': 1,
+            'cpu.time': 10 ** 12 + self.index, 'cpu.user': 10 ** 11, 'cpu.system': 10 ** 10,
+            'balloon.current': 4194304, 'balloon.maximum': 4194304, 'balloon.available': 4000000,
+            'balloon.unused': 1000000, 'balloon.rss': 3000000,
+            'vcpu.current': HOST['vcpus'], 'vcpu.maximum': HOST['vcpus'],
+            'net.count': HOST['nics'], 'block.count': HOST['disks'],
+        }
+        for vcpu in range(HOST['vcpus']):
+            stats['vcpu.{}.state'.format(vcpu)] = 1
+            stats['vcpu.{}.time'.format(vcpu)] = 10 ** 11 + vcpu
+            stats['vcpu.{}.wait'.format(vcpu)] = 0
+        for nic in range(HOST['nics']):
+            for key, value in [('name', 'tap{:08x}-{}'.format(self.index, nic)), ('rx.bytes', 10 ** 9),
+                               ('rx.pkts', 10 ** 6), ('rx.errs', 0), ('rx.drop', 0), ('tx.bytes', 10 ** 9),
+                               ('tx.pkts', 10 ** 6), ('tx.errs', 0), ('tx.drop', 0)]:
+                stats['net.{}.{}'.format(nic, key)] = value
+        for disk in range(HOST['disks']):
+            for key, value in [('name', 'vd' + chr(ord('a') + disk)), ('path', 'vms/{}_disk'.format(self.uuid)),
+                               ('rd.reqs', 10 ** 5), ('rd.bytes', 10 ** 9), ('rd.times', 10 ** 9),
+                               ('wr.reqs', 10 ** 5), ('wr.bytes', 10 ** 9), ('wr.times', 10 ** 9),
+                               ('fl.reqs', 10 ** 3), ('fl.times', 10 ** 6), ('allocation', 10 ** 10),
+                               ('capacity', 4 * 10 ** 10), ('physical', 4 * 10 ** 10)]:
+                stats['block.{}.{}'.format(disk, key)] = value
+        return stats
+
+
+class virConnect:
+    def __init__(self):
+        self.domains = [virDomain(self, index) for index in range(HOST['domains'])]
+        self.alive = True
+
+    def listAllDomains(self, flags=0):
+        remote_call()
+        return list(self.domains)
+
+    def lookupByName(self, name):
+        remote_call()
+        for domain in self.domains:
+            if domain.name() == name:
+                return domain
+        raise libvirtError('Domain not found: {}'.format(name), VIR_ERR_NO_DOMAIN)
+
+    def lookupByUUIDString(self, uuidstr):
+        remote_call()
+        for domain in self.domains:
+            if domain.UUIDString() == uuidstr:
+                return domain
+        raise libvirtError('Domain not found: {}'.format(uuidstr), VIR_ERR_NO_DOMAIN)
+
+    def domainListGetStats(self, doms, stats=0, flags=0):
+        remote_call()
+        if not stats:
+            return [(domain, domain.stats()) for domain in doms]
+        prefixes = tuple(prefix for flag, prefix in STATS_PREFIXES if stats & flag)
+        return [(domain, dict((key, value) for key, value in domain.stats().items() if key.startswith(prefixes)))
+                for domain in doms]
+
+    def getAllDomainStats(self, stats=0, flags=0):
+        return self.domainListGetStats(self.domains, stats, flags)
+
+    def setKeepAlive(self, interval, count):
+        return 0
+
+    def registerCloseCallback(self, cb, opaque):
+        return 0
+
+    def unregisterCloseCallback(self):
+        return 0
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        return eventID
+
+    def domainEventDeregisterAny(self, callbackID):
+        return 0
+
+    def isAlive(self):
+        return 1 if self.alive else 0
+
+    def close(self):
+        self.alive = False
+        return 0
+
+
+def openReadOnly(name=None):
+    return virConnect()
+
+
+def virEventRegisterDefaultImpl():
+    return 0
+
+
+def virEventRunDefaultImpl():
+    time.sleep(1)
+    return 0
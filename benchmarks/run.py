@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Benchmarks
+==========
+
+Benchmark collection cycle of the exporter against a synthetic hypervisor.
+
+Every scale (number of domains) is measured in its own process using fake
+libvirt (`fakelibvirt.py`) and fake PCI devices (`fakehost.py`). Measured are
+collection cycle time, peak memory, allocations and scrape latency. Results
+are written as JSON and can be compared with results of another run.
+
+.. code-block:: bash
+
+    python3 benchmarks/run.py --output before.json
+    python3 benchmarks/run.py --domains 10,100 --output after.json --compare before.json
+
+Real host shapes are benchmarked by replaying a capture recorded by
+`libvirt_exporter.py capture` instead of the synthetic hypervisor:
+
+.. code-block:: bash
+
+    python3 benchmarks/run.py --replay libvirt-capture.json.gz --output replay.json
+
+Requires prometheus_client.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'ansible', 'files')
+
+# Results printed by comparison of runs
+COMPARED = [
+    'cycle_median_seconds',
+    'first_cycle_seconds',
+    'peak_traced_bytes',
+    'scrape_median_seconds',
+    'scrape_gzip_median_seconds',
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def summary(prefix, values):
+    return {
+        '{}_min_seconds'.format(prefix): min(values),
+        '{}_median_seconds'.format(prefix): statistics.median(values),
+        '{}_p95_seconds'.format(prefix): percentile(values, 0.95),
+    }
+
+
+def scrape(url, gzip=False):
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'} if gzip else {})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return time.perf_counter() - start, len(body)
+
+
+def load_replay(args, root):
+    """Import exporter modules replaying capture file."""
+    sys.path[:0] = [EXPORTER_DIR]
+    import instrumentation
+    import libvirtconnection
+    import libvirtmetadata
+    import libvirtreplay
+    capture = libvirtreplay.load(args.replay)
+    libvirtreplay.install(libvirtmetadata, libvirtconnection, instrumentation)
+    import libvirt_exporter
+    return libvirt_exporter, capture.create_pci_tree(root)
+
+
+def load_exporter(args, host):
+    """Import exporter modules using fake libvirt."""
+    sys.path[:0] = [BENCHMARKS_DIR, EXPORTER_DIR]
+    import fakelibvirt
+    fakelibvirt.configure(
+        domains=args.single, vcpus=args.vcpus, disks=args.disks, nics=args.nics,
+        hostdevs=args.hostdevs, gpus=host['gpus'], latency=args.latency / 1000.0)
+    sys.modules['libvirt'] = fakelibvirt
+    import libvirt_exporter
+    return libvirt_exporter
+
+
+def run_single(args):
+    """Benchmark one scale in this process, print results as JSON."""
+    from fakehost import create_host
+
+    root = tempfile.mkdtemp(prefix='libvirt-exporter-bench-')
+    try:
+        if args.replay:
+            exporter, pci_devices = load_replay(args, root)
+        else:
+            host = create_host(root, gpus=args.gpus)
+            exporter = load_exporter(args, host)
+            pci_devices = host['sysfs']
+        from prometheus_client import CollectorRegistry
+
+        libv_meta = exporter.LibvirtMetadata()
+        libv_meta.PCI_DEVICES = pci_devices
+        registry = CollectorRegistry()
+        cc = exporter.CustomCollector(
+            'Libvirt instance stats', helper_name='libvirt', libv_meta=libv_meta, registry=registry)
+        cc.WORKERS = args.workers
+        registry.register(cc)
+        start = time.perf_counter()
+        libv_meta.load_libvirt_metadata()
+        result = {'domains': len(libv_meta.LIBVIRT_INSTANCES) if args.replay else args.single}
+        result['load_metadata_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exporter.prom_stats(libv_meta, cc)
+        result['first_cycle_seconds'] = time.perf_counter() - start
+
+        cycles = []
+        for _ in range(args.cycles):
+            start = time.perf_counter()
+            exporter.prom_stats(libv_meta, cc)
+            cycles.append(time.perf_counter() - start)
+        result.update(summary('cycle', cycles))
+
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        exporter.prom_stats(libv_meta, cc)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_traced_bytes'] = peak
+        result['retained_traced_bytes'] = current
+        result['allocated_blocks_delta'] = sys.getallocatedblocks() - blocks
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        result['samples'] = cc.snapshot.samples
+        result['exposition_bytes'] = len(cc.snapshot.data)
+        result['exposition_gzip_bytes'] = len(cc.snapshot.gzip)
+
+        server = exporter.start_snapshot_server(0, '127.0.0.1', cc)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        try:
+            for gzip, prefix in [(False, 'scrape'), (True, 'scrape_gzip')]:
+                latencies = [scrape(url, gzip)[0] for _ in range(args.scrapes)]
+                result.update(summary(prefix, latencies))
+        finally:
+            server.shutdown()
+        print(json.dumps(result))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run(args):
+    """Benchmark every scale in a separate process."""
+    results = []
+    scales = [0] if args.replay else [int(value) for value in args.domains.split(',')]
+    for domains in scales:
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(domains)]
+        for option in ['cycles', 'scrapes', 'vcpus', 'disks', 'nics', 'hostdevs', 'gpus', 'latency', 'workers']:
+            command += ['--{}'.format(option), str(getattr(args, option))]
+        if args.replay:
+            command += ['--replay', args.replay]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout.decode()
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        sys.stderr.write('{domains:>6} domains: cycle {cycle_median_seconds:.4f}s, first {first_cycle_seconds:.4f}s, '
+                         'peak {peak_traced_bytes:,} B, scrape {scrape_median_seconds:.4f}s, '
+                         '{samples} samples\n'.format(**result))
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except Exception:
+        commit = ''
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': dict((key, value) for key, value in vars(args).items() if key not in ['output', 'compare']),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(args.compare, report)
+
+
+def compare(path, report):
+    """Print change of results against results stored in `path`."""
+    with open(path) as f:
+        baseline = dict((result['domains'], result) for result in json.load(f)['results'])
+    for result in report['results']:
+        other = baseline.get(result['domains'])
+        if not other:
+            continue
+        changes = []
+        for key in COMPARED:
+            if other.get(key):
+                changes.append('{} {:+.1%}'.format(key, result[key] / other[key] - 1))
+        sys.stderr.write('{:>6} domains: {}\n'.format(result['domains'], ', '.join(changes)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark libvirt exporter with synthetic hypervisor')
+    parser.add_argument('--domains', default='10,100,500,2000', help='Comma separated numbers of domains')
+    parser.add_argument('--cycles', default=5, type=int, help='Measured collection cycles')
+    parser.add_argument('--scrapes', default=50, type=int, help='Measured scrapes')
+    parser.add_argument('--vcpus', default=4, type=int, help='Vcpus per domain')
+    parser.add_argument('--disks', default=2, type=int, help='Disks per domain')
+    parser.add_argument('--nics', default=2, type=int, help='NICs per domain')
+    parser.add_argument('--hostdevs', default=1, type=int, help='PCI hostdevs per domain (while GPUs last)')
+    parser.add_argument('--gpus', default=8, type=int, help='GPUs of the host')
+    parser.add_argument('--latency', default=0.0, type=float, help='Milliseconds added to every libvirt call')
+    parser.add_argument('--workers', default=0, type=int, help='Parallel collection workers')
+    parser.add_argument('--replay', help='Replay capture file instead of synthetic hypervisor')
+    parser.add_argument('--output', help='Write results to JSON file (default: stdout)')
+    parser.add_argument('--compare', help='Compare results with JSON file of another run')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single is not None:
+        run_single(args)
+    else:
+        run(args)
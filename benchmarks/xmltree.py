@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+XML tree benchmark
+==================
+
+Benchmark conversion of libvirt XML into dict (`LibvirtMetadata._load_xml_tree`)
+against the previous converter walking all descendants of every element,
+and streaming parse of domain definition (`LibvirtMetadata.load_domain_definition`)
+against parse of the whole element tree.
+
+Converted are nova metadata of a domain (as returned by libvirt, without
+namespace), PCI hostdevs of domain XML and the domain XML itself, synthetic
+by default. Metadata and domain XML of a real domain can be given instead:
+
+.. code-block:: bash
+
+    virsh metadata instance-00000001 http://openstack.org/xmlns/libvirt/nova/1.1 > metadata.xml
+    virsh dumpxml instance-00000001 > domain.xml
+    python3 benchmarks/xmltree.py --metadata metadata.xml --domain domain.xml
+
+Values read by the exporter (instance name, project, hostdev alias, driver
+and source address, CPU model, features and disks) are checked to be equal
+for both implementations.
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'ansible', 'files')
+
+
+def previous_load_xml_tree(tree):
+    """Previous converter, every descendant is loaded again by its ancestors."""
+    data = {}
+    if tree.keys():
+        data = dict(tree.items())
+    if len(tree):
+        for item in tree.iter():
+            if item != tree:
+                data[item.tag] = previous_load_xml_tree(item)
+    elif tree.text and tree.text.strip():
+        if data:
+            data['value'] = tree.text
+        else:
+            return tree.text
+    return data if data else ''
+
+
+def previous_load_domain_definition(xml_string):
+    """Previous parser of domain definition, whole element tree is built."""
+    domain_config = ET.fromstring(xml_string)
+    cpu_model, cpu_fallback, cpu_features = None, 0, []
+    cpu = domain_config.find('.//cpu')
+    if cpu is not None:
+        cpu_features = [
+            (feature.get('name'), 1 if (feature.get('policy') == 'require') else 0)
+            for feature in cpu.findall('.//feature')
+        ]
+        model = cpu.find('.//model')
+        if model is not None:
+            cpu_model = model.text
+            cpu_fallback = 1 if (model.get('fallback') == 'allow') else 0
+    hostdevs = {}
+    for item in domain_config.findall('.//hostdev'):
+        try:
+            gpu_info = previous_load_xml_tree(item)
+            address = gpu_info.get('source', {}).get('address', {})
+            key = '{}:{}:{}.{}'.format(
+                address.get('domain')[2:], address.get('bus')[2:], address.get('slot')[2:],
+                address.get('function')[2:])
+            hostdevs[key] = dict(
+                type=gpu_info.get('type'),
+                alias=gpu_info.get('alias', {}).get('name', 'hostdev'),
+                driver=gpu_info.get('driver', {}).get('name', 'unknown'),
+                pci_domain=address.get('domain', 'unknown'),
+                bus=address.get('bus', 'unknown'),
+                slot=address.get('slot', 'unknown'),
+                function=address.get('function', 'unknown'),
+            )
+        except Exception:
+            pass
+    disks = []
+    for disk in domain_config.findall('.//disk'):
+        source = disk.find('source')
+        disks.append({
+            'source': dict(source.items()) if source is not None else None,
+            'hosts': [dict(host.items()) for host in source] if source is not None else [],
+            'auth': dict(disk.find('auth').items()) if disk.find('auth') is not None else None,
+            'driver': dict(disk.find('driver').items()) if disk.find('driver') is not None else None,
+            'target': dict(disk.find('target').items()) if disk.find('target') is not None else None,
+        })
+    return cpu_model, cpu_fallback, cpu_features, hostdevs, disks
+
+
+def consumed_definition(definition):
+    if isinstance(definition, tuple):
+        return definition
+    return definition.cpu_model, definition.cpu_fallback, definition.cpu_features, definition.hostdevs, [
+        dict(disk, hosts=[host for host in disk['hosts'] if host.get('name') and host.get('port')])
+        for disk in definition.disks]
+
+
+def consumed_metadata(data):
+    return data.get('name', 'unknown'), data.get('owner', {}).get('project', {}).get('value', 'unknown')
+
+
+def consumed_hostdev(data):
+    return (
+        data.get('type'),
+        data.get('alias', {}).get('name', 'hostdev'),
+        data.get('driver', {}).get('name', 'unknown'),
+        data.get('source', {}).get('address', {}),
+    )
+
+
+def measure(convert, elements, number):
+    """Seconds per conversion of all `elements`."""
+    def run():
+        for element in elements:
+            convert(element)
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def peak_memory(convert, elements):
+    """Peak traced bytes of conversion of all `elements`."""
+    tracemalloc.start()
+    for element in elements:
+        convert(element)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(args):
+    sys.path[:0] = [BENCHMARKS_DIR, EXPORTER_DIR]
+    import fakelibvirt
+    fakelibvirt.configure(domains=1, nics=args.nics, disks=args.disks, hostdevs=args.hostdevs,
+                          gpus=[(0, 0x3b + n // 4, n % 4, 0) for n in range(args.hostdevs)])
+    sys.modules['libvirt'] = fakelibvirt
+    from libvirtmetadata import LibvirtMetadata
+    libv_meta = LibvirtMetadata()
+
+    if args.metadata:
+        with open(args.metadata) as f:
+            metadata = f.read()
+    else:
+        metadata = fakelibvirt.nova_metadata(0, namespace=False)
+    if args.domain:
+        with open(args.domain) as f:
+            domain = f.read()
+    else:
+        domain = fakelibvirt.virConnect().domains[0].XMLDesc()
+
+    shapes = [
+        ('nova metadata', [ET.fromstring(metadata)], consumed_metadata,
+         libv_meta._load_xml_tree, previous_load_xml_tree),
+        ('hostdevs', ET.fromstring(domain).findall('.//hostdev'), consumed_hostdev,
+         libv_meta._load_xml_tree, previous_load_xml_tree),
+        ('definition', [domain], consumed_definition,
+         libv_meta.load_domain_definition, previous_load_domain_definition),
+    ]
+    for shape, elements, consumed, convert, previous_convert in shapes:
+        if not elements:
+            print('{:>14}: no elements'.format(shape))
+            continue
+        for element in elements:
+            if consumed(convert(element)) != consumed(previous_convert(element)):
+                raise SystemExit('{}: converted values differ'.format(shape))
+        current = measure(convert, elements, args.number)
+        previous = measure(previous_convert, elements, args.number)
+        size = sum(1 for element in elements for _ in (
+            ET.fromstring(element) if isinstance(element, str) else element).iter())
+        print('{:>14}: {} elements, {:.1f} us (previous {:.1f} us, {:.1f}x), peak {:,} B (previous {:,} B)'.format(
+            shape, size, current * 1e6, previous * 1e6, previous / current,
+            peak_memory(convert, elements), peak_memory(previous_convert, elements)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark conversion of libvirt XML into dict')
+    parser.add_argument('--metadata', help='Nova metadata XML of a domain (default: synthetic)')
+    parser.add_argument('--domain', help='Domain XML (default: synthetic)')
+    parser.add_argument('--nics', default=4, type=int, help='NICs (nova ports) of synthetic domain')
+    parser.add_argument('--disks', default=2, type=int, help='Disks of synthetic domain')
+    parser.add_argument('--hostdevs', default=4, type=int, help='PCI hostdevs of synthetic domain')
+    parser.add_argument('--number', default=1000, type=int, help='Conversions per measurement')
+    main(parser.parse_args())